@@ -0,0 +1,174 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZES = [1000, 10000, 100000]  # up to 10 million trees with --sizes
+SPECIES_MIX = {"Pb": 0.35, "Ec": 0.35, "Pm": 0.15, "Sb": 0.15}
+STATUS_MIX = {1: 0.88, 2: 0.07, 3: 0.03, 4: 0.02}  # alive, dead, ... and stumps
+
+def generate_inventory(n, path, seed=0, missing_dbh=0.05, missing_height=0.4, species_mix=SPECIES_MIX, status_mix=STATUS_MIX):
+    # Writes a synthetic tree data file like the ones of the field crews: a mix of species, some dead trees
+    # and stumps, heights that follow the height-diameter curves of each species and missing DBH or height values
+    import pandas as pd
+    from project import HD_COEFFICIENTS
+    rng = np.random.default_rng(seed)
+    kind = rng.choice(len(species_mix), size=n, p=list(species_mix.values()))
+    species = np.array(list(species_mix))[kind]
+    cod_status = rng.choice(list(status_mix), size=n, p=list(status_mix.values()))
+
+    dbh = np.where(species == "Ec", 5, 7.5) + rng.gamma(2.5, 6, size=n)
+    a, b, c0, c1 = np.array([HD_COEFFICIENTS[code] for code in species_mix])[kind].T
+    d = c0 + c1 * dbh  # Sb heights come from the diameter under the cork
+    height = d / (a + b * d) * rng.lognormal(0, 0.1, size=n)
+
+    dbh = dbh.round(1)
+    height = height.round(1)
+    no_height = rng.random(n) < missing_height
+    no_dbh = ~no_height & (rng.random(n) < missing_dbh)  # alive trees always have one of them
+    height[no_height] = np.nan
+    height[cod_status == 4] = 0  # stumps have no height
+    dbh[no_dbh] = np.nan
+
+    pd.DataFrame({
+        "tree_ID": np.arange(1, n + 1),
+        "species": species,
+        "DBH": dbh,
+        "height": height,
+        "COD_Status": cod_status,
+    }).to_csv(path, index=False)
+    return path
+
+def run_stages(path, area=1000, out_dir=None, memory=False):
+    # One run of the analysis of a file split in the stages of the program, returns the seconds
+    # (and with memory=True the peak of memory allocated, in MB) of each stage
+    import pandas as pd
+    import project
+    out_dir = out_dir or os.path.dirname(path)
+    stand = project.Stand()
+    stand.Main_species = "Mixed Stand"
+    stand.Area = area
+    results = {}
+
+    @contextlib.contextmanager
+    def stage(name):
+        if memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        results[name] = {"seconds": time.perf_counter() - start}
+        if memory:
+            results[name]["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+
+    if memory:
+        tracemalloc.start()
+    try:
+        with stage("read_csv"):
+            df = pd.read_csv(path)
+        with stage("create_tree_objects"):
+            project.validate_columns(df, False)
+            table = project.tree_table_from_dataframe(df)
+        del df
+        with stage("calculate_missing_dbh_h"):
+            project.calculate_missing_dbh_h(table)
+        with stage("stand_metrics"):
+            project.stand_metrics(None, table, stand)
+        with stage("export_to_csv"), contextlib.redirect_stdout(io.StringIO()):
+            project.export_to_csv(table, stand, os.path.join(out_dir, "bench_metrics_tree.csv"), os.path.join(out_dir, "bench_metrics_stand.csv"))
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return results
+
+def bench_stages(sizes=SIZES, repeat=3, data_dir=None, memory=True):
+    # Times every stage at each size, the best of `repeat` runs (the least disturbed by the rest of the machine).
+    # Memory is measured in a separate run because tracing the allocations slows the program down
+    report = {}
+    with tempfile.TemporaryDirectory() as temporary:
+        data_dir = data_dir or temporary
+        os.makedirs(data_dir, exist_ok=True)
+        for n in sizes:
+            path = os.path.join(data_dir, f"inventory_{n}.csv")
+            if not os.path.exists(path):
+                generate_inventory(n, path)
+            runs = [run_stages(path) for _ in range(repeat)]
+            stages = {name: {"seconds": round(min(run[name]["seconds"] for run in runs), 4)} for name in runs[0]}
+            if memory:
+                for name, values in run_stages(path, memory=True).items():
+                    stages[name]["peak_mb"] = values["peak_mb"]
+            stages["total"] = {"seconds": round(sum(values["seconds"] for values in stages.values()), 4)}
+            report[str(n)] = stages
+    return report
+
+def compare_to_baseline(report, baseline, tolerance=1.5, min_seconds=0.005):
+    # Returns the stages that got slower than the baseline by more than `tolerance` times
+    # (stages faster than min_seconds are too noisy to compare)
+    regressions = []
+    for size, stages in report.get("stages", {}).items():
+        for name, values in stages.items():
+            before = baseline.get("stages", {}).get(size, {}).get(name)
+            if before and values["seconds"] > before["seconds"] * tolerance and values["seconds"] - before["seconds"] > min_seconds:
+                regressions.append(f"{name} with {size} trees: {values['seconds']}s, was {before['seconds']}s")
+    return regressions
+
+def bench_startup(runs=10):
+    # Time a new Python process takes to import project.py, which every short-lived batch job pays.
+    # Each run is a fresh interpreter, so nothing is already imported
+    code = (
+        "import sys, time; start = time.perf_counter(); import project; "
+        "print(time.perf_counter() - start, 'pandas' in sys.modules, 'matplotlib' in sys.modules)"
+    )
+    import_times = []
+    process_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True, check=True).stdout.split()
+        process_times.append(time.perf_counter() - start)
+        import_times.append(float(output[0]))
+    return {
+        "runs": runs,
+        "import_ms_median": round(statistics.median(import_times) * 1000, 1),
+        "import_ms_min": round(min(import_times) * 1000, 1),
+        "process_ms_median": round(statistics.median(process_times) * 1000, 1),
+        "pandas_imported": output[1] == "True",
+        "matplotlib_imported": output[2] == "True",
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Forest Inventory Assistant benchmarks")
+    parser.add_argument("--runs", type=int, default=10, help="number of fresh processes to time (default 10)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of trees of the synthetic inventories (default 1000 10000 100000)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each size, the fastest one is reported (default 3)")
+    parser.add_argument("--no-memory", action="store_true", help="do not measure the peak memory of each stage")
+    parser.add_argument("--data-dir", help="keep the generated inventories in this folder and reuse them")
+    parser.add_argument("--save-baseline", metavar="FILE", help="save the results as the baseline to compare with")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with a saved baseline, exits with an error if a stage got slower")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="how many times slower a stage can get before it is a regression (default 1.5)")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, HERE)
+    report = {"startup": bench_startup(args.runs), "stages": bench_stages(args.sizes, args.repeat, args.data_dir, not args.no_memory)}
+    print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(report, json.load(file), args.tolerance)
+        if regressions:
+            sys.exit("Slower than the baseline:\n" + "\n".join(regressions))
+        print("No stage is slower than the baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,44 @@
-import pandas as pd
 import sys
-import matplotlib.pyplot as plt
+import os
+import glob
+import argparse
+import contextlib
+import hashlib
+import json
 import math
+import time
+import numpy as np
+
+# pandas and matplotlib take most of the start up time of the program, so they are
+# only imported inside the functions that use them (Python keeps them loaded after the first time)
+
+SPECIES = []  # the species codes of species_models.json, filled by load_species_models()
+TREE_METRICS = ["basal_area", "tree_volume", "merc_volume", "wood_value", "trunk_biom", "bark_biom", "branch_biom", "leaves_biom", "aerial_biom", "roots_biom", "total_biom"]
+TREE_COLUMNS = {"tree_ID": "int64", "species": "str", "est_dbh": "float64", "dbh": "float64", "height": "float64", "est_height": "float64", "cod_status": "int8"}
+TREE_COLUMNS.update({name: "float64" for name in TREE_METRICS})
+TREE_EXPORT_COLUMNS = [  # (column of the exported tables, TreeTable attribute, decimals in the text tables)
+    ("Tree ID", "tree_ID", None),
+    ("Species", "species", None),
+    ("COD_Status", "cod_status", None),
+    ("DBH (cm)", "est_dbh", None),
+    ("Height (m)", "est_height", None),
+    ("Volume (m³)", "tree_volume", 4),
+    ("Mercantile Volume (m³)", "merc_volume", 4),
+    ("Wood_Value (€)", "wood_value", 2),
+    ("Basal area (m²)", "basal_area", 4),
+    ("Trunk Biomass (kg)", "trunk_biom", 4),
+    ("Bark Biomass (kg)", "bark_biom", 4),
+    ("Branches Biomass (kg)", "branch_biom", 4),
+    ("Needles Biomass (kg)", "leaves_biom", 4),
+    ("Aerial Biomass (kg)", "aerial_biom", 4),
+    ("Roots Biomass (kg)", "roots_biom", 4),
+    ("Total Biomass (kg)", "total_biom", 4),
+]
+HD_COEFFICIENTS = {}  # height-diameter curves h = du / (a + b*du), du = c0 + c1*dbh: (a, b, c0, c1) of each species
+EQUATION_METRICS = ["tree_volume", "merc_volume", "trunk_biom", "bark_biom", "branch_biom", "leaves_biom", "roots_biom"]
+MIN_DBH = 7.5  # smallest DBH of a tree (cm) of the species without a "min_dbh" in species_models.json
+MODEL_VERSION = 1  # increase it when an equation or a coefficient changes, so the cached results are calculated again
+TABLE_FORMATS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
 
 def welcome_message():
     print("---")
@@ -75,25 +112,32 @@ def input_stand_area():
             print("The stand area is not a numerical value, please enter a valid input.")
     Stand.Area = stand_area
 
-def read_data(file_path):
+def read_data(file_path, allow_extra_columns=None, verbose=True):
     Tree.clear_tree_list()  # Clear any existing trees before importing new data
     Stand.Main_species = "Mixed Stand"
+    Tree.tree_list.extend(read_tree_table(file_path, allow_extra_columns, verbose))
 
-    print("\nImporting the Data table...\n")
+def read_tree_table(file_path, allow_extra_columns=None, verbose=True):
+    # Reads and validates a csv file and returns its trees in a new TreeTable
+    import pandas as pd
+    if verbose:
+        print("\nImporting the Data table...\n")
     try:
         df = pd.read_csv(file_path)
-        validate_columns(df)
-        create_tree_objects(df)
-        if not Tree.tree_list:
+        validate_columns(df, allow_extra_columns)
+        table = tree_table_from_dataframe(df)
+        if not table:
             raise ValueError("The given file is empty, please correct and restart.")
-        print("Data imported successfully.")
-        print(f"\nHere is the input table: {file_path}")
-        print(df.to_string(index=False))
-        print("")
+        if verbose:
+            print("Data imported successfully.")
+            print(f"\nHere is the input table: {file_path}")
+            print(df.to_string(index=False))
+            print("")
+        return table
     except FileNotFoundError:
         raise FileNotFoundError("There was an error reading the file, please correct and restart.")
 
-def validate_columns(dataframe):
+def validate_columns(dataframe, allow_extra_columns=None):
     required_columns = {"tree_ID", "species", "DBH", "height", "COD_Status"}
     dataframe_columns = set(dataframe.columns)
     missing_columns = required_columns - dataframe_columns
@@ -103,43 +147,216 @@ def validate_columns(dataframe):
         raise ValueError(f"There are required columns missing in the file: {', '.join(missing_columns_list)}")
     if extra_columns:
         extra_columns_list = sorted(list(extra_columns))
+        if allow_extra_columns is False:
+            raise ValueError(f"There are extra columns in the file: {', '.join(extra_columns_list)}, please correct and restart.")
         print(f"There are extra columns in the file: {', '.join(extra_columns_list)}")
-        print("Are you sure? The extra columns will not be taken into account by the program.")
-        answer = input("Press <Enter> to continue, press any other button to close\n")
-        if answer.strip() != "":
-            sys.exit("Closing...\n")
-
-def create_tree_objects(df):
-    for _, row in df.iterrows():
-        tree_ID = row.get("tree_ID", None)
-        species = row.get("species", None)
-        dbh = row.get("DBH", None)
-        height = row.get("height", None)
-        cod_status = row.get("COD_Status", None)
-        
-        if pd.isna(cod_status):
-            cod_status = 1
-
-        if species == "Eu":
-           species = "Ec" 
+        if allow_extra_columns is None:  # ask the user
+            print("Are you sure? The extra columns will not be taken into account by the program.")
+            answer = input("Press <Enter> to continue, press any other button to close\n")
+            if answer.strip() != "":
+                sys.exit("Closing...\n")
 
-        tree = Tree(tree_ID, species, dbh, height, int(cod_status))
+def find_duplicate_tree_IDs(df):
+    # Checks the whole tree_ID column at once and returns every ID that appears more than once
+    import pandas as pd
+    tree_IDs = pd.to_numeric(df["tree_ID"], errors="coerce").dropna()
+    duplicates = tree_IDs[tree_IDs.duplicated()].unique()
+    return [int(tree_ID) if tree_ID == int(tree_ID) else tree_ID for tree_ID in duplicates]
+
+def validate_tree_data(df):
+    # Checks the five columns of the whole table at once instead of one tree at a time.
+    # Returns the cleaned columns and a list of (line in the file, message) with every problem found
+    import pandas as pd
+    errors = []
+    lines = df.index.to_numpy() + 2  # the header is the first line of the file (chunks keep counting the rows)
+
+    def report(mask, message):
+        for line in lines[np.asarray(mask, dtype=bool)]:
+            errors.append((int(line), message))
+
+    duplicates = find_duplicate_tree_IDs(df)
+    if len(duplicates) == 1:
+        errors.append((None, f"Tree ID {duplicates[0]} is duplicate in the table, please correct and restart."))
+    elif duplicates:
+        errors.append((None, f"Tree IDs {', '.join(str(tree_ID) for tree_ID in duplicates)} are duplicate in the table, please correct and restart."))
+
+    tree_ID = df["tree_ID"]
+    tree_ID_num = pd.to_numeric(tree_ID, errors="coerce")
+    report(tree_ID.isna(), "There is a missing tree_id value, please correct and restart")
+    report(tree_ID.notna() & tree_ID_num.isna(), "There is a non-integer tree_id value, please correct and restart")
+    decimal = tree_ID_num.notna() & (tree_ID_num != np.floor(tree_ID_num))
+    report(decimal, "There is a decimal tree_id value, please correct and restart")
+    report(~decimal & (tree_ID_num <= 0), "There is a non-positive tree_id value, please correct and restart")
+
+    species = df["species"].replace(MODELS.aliases)
+    report(species.isna(), "There is a missing species value, please correct and restart")
+    report(species.notna() & ~species.isin(SPECIES), species_error())
+
+    cod_status = pd.to_numeric(df["COD_Status"], errors="coerce").where(df["COD_Status"].notna(), 1)
+
+    dbh = pd.to_numeric(df["DBH"], errors="coerce")
+    report(df["DBH"].notna() & dbh.isna(), "There is a DBH value that cannot be converted to float, please correct and restart.")
+    report(dbh < 0, "There is a negative DBH value, please correct and restart.")
+    short = (dbh >= 0) & (dbh < species.map({code: MODELS.min_dbh(code) for code in SPECIES}).fillna(MIN_DBH))
+    messages = species.map({code: min_dbh_error(code) for code in SPECIES}).fillna(min_dbh_error(None))
+    for message in messages[short].unique():
+        report(short & (messages == message), message)
+
+    height = pd.to_numeric(df["height"], errors="coerce")
+    not_float = df["height"].notna() & height.isna()
+    report(not_float, "There is a height value that cannot be converted to float. Please correct and restart.")
+    report(height < 0, "There is a negative height value, Please correct and restart.")
+    report(~not_float & ~(height < 0) & (height != 0) & (cod_status == 4), "There is a stump with a height value, Please correct and restart.")
+
+    report(~cod_status.isin([1, 2, 3, 4]), "There is an invalid COD_status value, please correct and restart")
+    report(dbh.isna() & height.isna() & (cod_status == 1), "There are trees without DBH and height values, please correct and restart")
+
+    errors.sort(key=lambda error: 0 if error[0] is None else error[0])
+    if errors:
+        return None, errors
+
+    columns = {
+        "tree_ID": tree_ID_num.to_numpy(dtype="int64"),
+        "species": species.to_numpy(dtype=object),
+        "dbh": dbh.to_numpy(dtype=float),
+        "height": height.to_numpy(dtype=float),
+        "cod_status": cod_status.to_numpy(dtype="int64"),
+    }
+    return columns, errors
 
-        tree.set_attributes(tree_ID, species, dbh, height, cod_status)
-        Tree.tree_list.append(tree)  # Add the tree to the Tree class-level list
+def validation_report(errors):
+    messages = [message if line is None else f"Line {line}: {message}" for line, message in errors]
+    if len(messages) == 1:
+        return messages[0]
+    return f"There are {len(messages)} problems in the file, please correct and restart:\n" + "\n".join(messages)
 
-        if math.isnan(dbh) and math.isnan(height) and cod_status == 1:
-            raise ValueError("There are trees without DBH and height values, please correct and restart") # Exiting if both DBH and height are missing
+def create_tree_objects(df):
+    Tree.tree_list.extend(tree_table_from_dataframe(df))
+    return Tree.tree_list  # Return the class-level table of trees
+
+def tree_table_from_dataframe(df):
+    columns, errors = validate_tree_data(df)
+    if errors:
+        raise ValueError(validation_report(errors))
+    return TreeTable(columns)  # The values were already validated
+
+class TreeTable:
+    # The trees stored as columns, one typed NumPy array per attribute (tree_ID, species, dbh, ...),
+    # so they take a fraction of the memory of one object per tree and the calculations work on whole columns.
+    # Iterating over the table gives Tree objects made from each row, changing them does not change the table
+
+    def __init__(self, columns=None):
+        columns = columns or {}
+        n = len(next(iter(columns.values()))) if columns else 0
+        for name, dtype in TREE_COLUMNS.items():
+            if name in columns:
+                values = columns[name]
+            elif name == "est_dbh" and "dbh" in columns:
+                values = columns["dbh"]
+            elif name == "est_height" and "height" in columns:
+                values = columns["height"]
+            else:
+                values = np.zeros(n)
+            setattr(self, name, np.array(values, dtype=dtype))
+        self._index = None
+        self._buffers = {}  # the arrays with spare room behind the columns filled by append()
 
-    return Tree.tree_list  # Return the class-level list of trees
+    @classmethod
+    def from_trees(cls, trees):
+        return cls({name: [getattr(tree, name) for tree in trees] for name in TREE_COLUMNS})
+
+    def columns(self):
+        return {name: getattr(self, name) for name in TREE_COLUMNS}
+
+    def __len__(self):
+        return len(self.tree_ID)
+
+    def __getitem__(self, i):
+        tree = Tree.__new__(Tree)
+        for name in TREE_COLUMNS:
+            setattr(tree, name, getattr(self, name)[i].item())
+        return tree
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self, rows):
+        # New table with only some of the trees (a boolean mask or a list of positions)
+        return TreeTable({name: values[rows] for name, values in self.columns().items()})
+
+    def extend(self, other):
+        n = len(self)
+        for name in TREE_COLUMNS:
+            setattr(self, name, np.concatenate([getattr(self, name), getattr(other, name)]).astype(TREE_COLUMNS[name]))
+        self._add_to_index(other.tree_ID.tolist(), n)
+
+    def append(self, tree):
+        # Adds one tree. The columns are views of arrays with spare room that double in size when they are full,
+        # so adding the trees one at a time does not copy the whole table for every tree
+        n = len(self)
+        for name, dtype in TREE_COLUMNS.items():
+            values = getattr(self, name)
+            buffer = self._buffers.get(name)
+            new_dtype = np.result_type(values, np.array([getattr(tree, name)])) if dtype == "str" else values.dtype
+            if buffer is None or values.base is not buffer or len(buffer) == n or buffer.dtype != new_dtype:
+                buffer = np.empty(max(2 * n, 16), dtype=new_dtype)
+                buffer[:n] = values
+                self._buffers[name] = buffer
+            buffer[n] = getattr(tree, name)
+            setattr(self, name, buffer[:n + 1])
+        self._add_to_index([tree.tree_ID], n)
+
+    def _add_to_index(self, tree_IDs, first_row):
+        # The new trees are added to the index of the tree IDs (if it was built) instead of building it again
+        if self._index is not None:
+            self._index.update(zip(tree_IDs, range(first_row, first_row + len(tree_IDs))))
+
+    def replace_rows(self, rows, other):
+        # Writes the trees of another table over some rows. The species column is widened first if the other
+        # table has longer species codes, a fixed width string array would cut them
+        if not np.array_equal(self.tree_ID[rows], other.tree_ID):
+            self._index = None
+        for name in TREE_COLUMNS:
+            values = getattr(self, name)
+            new_values = getattr(other, name)
+            if np.result_type(values, new_values) != values.dtype:
+                values = values.astype(np.result_type(values, new_values))
+                setattr(self, name, values)
+            values[rows] = new_values
+
+    def delete(self, rows):
+        # Removes some trees (a list of positions), the others keep their order
+        for name in TREE_COLUMNS:
+            setattr(self, name, np.delete(getattr(self, name), rows))
+        self._index = None
+
+    def clear(self):
+        for name in TREE_COLUMNS:
+            setattr(self, name, getattr(self, name)[:0].copy())
+        self._index = None
+        self._buffers = {}
+
+    def row_of(self, tree_ID):
+        # Position of a tree in the table, the index is only built when it is needed
+        if self._index is None:
+            self._index = {tree_ID: row for row, tree_ID in enumerate(self.tree_ID.tolist())}
+        return self._index.get(tree_ID)
+
+    def has_tree_ID(self, tree_ID):
+        return self.row_of(tree_ID) is not None
 
 class Tree:
-    tree_list = []  # This is the class-level list where all trees will be stored
+    tree_list = TreeTable()  # This is the class-level table where all trees will be stored
 
     @classmethod
     def clear_tree_list(self):
         self.tree_list.clear()
 
+    @classmethod
+    def add_tree(self, tree):
+        self.tree_list.append(tree)
+
     def __init__(self, tree_ID, species, dbh, height, cod_status):
         self.tree_ID = tree_ID
         self.species = species
@@ -167,9 +384,10 @@ class Tree:
     @staticmethod
     def is_duplicate_tree_ID(tree_ID):
         # Check if the tree ID already exists in the tree_list
-        return any(tree.tree_ID == tree_ID for tree in Tree.tree_list)
+        return Tree.tree_list.has_tree_ID(tree_ID)
 
     def set_tree_id(self, tree_ID):
+        import pandas as pd
         if pd.isna(tree_ID):
             raise ValueError("There is a missing tree_id value, please correct and restart")
         if not isinstance(tree_ID, int) and not isinstance(tree_ID, float):
@@ -181,11 +399,12 @@ class Tree:
         self.tree_ID = int(tree_ID)
 
     def set_species(self, species):
+        import pandas as pd
         if pd.isna(species):
             raise ValueError("There is a missing species value, please correct and restart")
         str(species).strip()
-        if species not in ["Pb", "Pm", "Ec", "Sb"]:
-            raise ValueError("There is a species value that is not acceptable (not 'Pb', 'Pm', 'Ec', or 'Sb'), please correct and restart") # Exiting if invalid species
+        if species not in SPECIES:
+            raise ValueError(species_error()) # Exiting if invalid species
         self.species = species
 
     def set_dbh(self, dbh, species):
@@ -196,10 +415,8 @@ class Tree:
             raise ValueError("There is a DBH value that cannot be converted to float, please correct and restart.") # Exits the program if DBH cannot be converted
         if dbh < 0:  # Checks if the value is negative
             raise ValueError("There is a negative DBH value, please correct and restart.") # Exits the program if DBH is negative
-        elif dbh < 7.5 and species != "Ec":  # Checks if the diameter is large enough to be considered a tree
-            raise ValueError("There is a DBH value that's less than 7.5cm, this is not considered a tree, please correct and restart.") # Exits the program if DBH is less than 7.5
-        elif dbh < 5:  # Checks if the diameter is large enough to be considered a tree (Ec are counted if they have more than 5cm of dbh)
-            raise ValueError("There is a Eucalyptus' DBH value that's less than 5cm, this is not considered a tree, please correct and restart.") # Exits the program if DBH is less than 7.5
+        elif dbh < MODELS.min_dbh(species):  # Checks if the diameter is large enough to be considered a tree (Ec are counted from 5cm)
+            raise ValueError(min_dbh_error(species)) # Exits the program if DBH is less than the minimum of the species
         
     def set_height(self, height, cod_status):
         try:
@@ -267,215 +484,332 @@ class Stand:
                 f"Stand density index: {self.SDI}")
 
 
-def calculate_missing_dbh_h():
-    for t in Tree.tree_list:
-        if math.isnan(t.height):
-            if t.species == "Pb":
-                t.est_height = round(t.dbh / (1.0643 + 0.0222 * t.dbh), 2)
-            if t.species == "Ec":
-                t.est_height = round(t.dbh / (0.6733 + 0.0130 * t.dbh), 2)
-            if t.species == "Pm":
-                t.est_height = round(t.dbh / (1.8104 + 0.0388 * t.dbh), 2)
-            if t.species == "Sb":
-                du_Sb = -1.5276 + 0.8321 * t.dbh #we assume that the cork is virgin, otherwise the calculations would be harder
-                t.est_height = round(du_Sb / (2.1124 + 0.0293 * du_Sb, 2))
-                
-        if math.isnan(t.dbh):
-            if t.species == "Pb":
-                t.est_dbh = round((-t.height*1.0643) / (t.height*0.0222 - 1), 2)
-            if t.species == "Ec":
-                t.est_dbh = round((-t.height*0.6733) / (t.height*0.0130 - 1), 2)
-            if t.species == "Pm":
-                t.est_dbh = round((-t.height*1.8104) / (t.height*0.0388 - 1), 2)
-            if t.species == "Sb":
-                t.est_dbh = round((-t.height*2.1124) / (t.height*0.0293 - 1), 2)
-
-
-def calculate_tree_metrics():
-    for t in Tree.tree_list:
-        t.basal_area = math.pi * (t.est_dbh / 100 / 2) ** 2
-
-        if t.species == "Pb":
-            if t.cod_status == 1 or t.cod_status == 2: 
-                t.tree_volume = 0.7520 * (t.est_dbh / 100) ** 2.0706 * t.est_height ** 0.8031
-
-                if t.cod_status == 1:
-                    t.merc_volume = 0.0000247 * t.est_dbh ** 2.1119 * t.est_height ** 0.9261
-                    t.trunk_biom = 0.0146 * t.est_dbh ** 1.94687 * t.est_height ** 1.106577
-                    t.bark_biom = 0.0114 * t.est_dbh ** 1.8728 * t.est_height ** 0.6694
-                    t.branch_biom = 0.00308 * t.est_dbh ** 2.75761 * (t.est_height / t.est_dbh) ** -0.39381
-                    t.leaves_biom = 0.09980 * t.est_dbh ** 1.39252 * (t.est_height / t.est_dbh) ** -0.71962
-                    t.aerial_biom = t.trunk_biom + t.bark_biom + t.branch_biom + t.leaves_biom
-                    t.roots_biom = 0.2756 * t.aerial_biom
-                    t.total_biom = t.aerial_biom + t.roots_biom
-
-                    t.wood_value = wood_value_Pb(t.est_dbh, t.est_height, t.merc_volume)
-        
-        if t.species == "Ec":
-            if t.cod_status == 1 or t.cod_status == 2: 
-                t.tree_volume = 0.2105 * (t.est_dbh / 100) ** 1.8191 * t.est_height ** 1.0703
-
-                if t.cod_status == 1:
-                    t.merc_volume = 0.1241 * (t.est_dbh / 100) ** 1.7829 * t.est_height ** 1.1564
-                    if Stand.hdom > 10.71:
-                        beta = 1.780459
-                    else:
-                        beta = Stand.hdom/(-0.70909 + 0.627861*Stand.hdom)
-                    t.trunk_biom = 0.009964 * t.est_dbh ** beta * t.est_height ** 1.369618
-                    if Stand.hdom > 18.2691:
-                        beta = 2.37947
-                    else:
-                        beta = Stand.hdom/(-0.69951 + 0.45855*Stand.hdom)
-                    t.bark_biom = 0.000594 * t.est_dbh ** beta * t.est_height ** 1.084988
-                    t.branch_biom = 0.095603 * t.est_dbh ** 1.674653 * (t.est_height / t.est_dbh) ** -0.85073
-                    t.leaves_biom = 0.248952 * t.est_dbh ** 1.264033 * (t.est_height / t.est_dbh) ** -0.7121
-                    t.aerial_biom = t.trunk_biom + t.bark_biom + t.branch_biom + t.leaves_biom
-                    t.roots_biom = 0.2487 * t.aerial_biom
-                    t.total_biom = t.aerial_biom + t.roots_biom
-
-                    t.wood_value = wood_value_Ec(t.est_dbh, t.est_height, t.merc_volume)
-
-
-        if t.species == "Pm":
-            if t.cod_status == 1 or t.cod_status == 2: 
-                t.tree_volume = 0.000094 * t.est_dbh ** 1.9693 * t.est_height ** 0.6530
-
-                if t.cod_status == 1:
-                    t.merc_volume = 0
-                    t.trunk_biom = 18.8544 * (math.pi * t.est_dbh) ** 1.6755 * t.est_height ** 0.9485
-                    t.bark_biom = 8.0810 * (math.pi * t.est_dbh) ** 1.5549 * t.est_height ** 0.4702
-                    t.branch_biom = 184,9365 * (math.pi * t.est_dbh) ** 3.0344 
-                    t.leaves_biom = 22.2677 * (math.pi * t.est_dbh) ** 1.7607 * (t.est_height / t.est_dbh) ** -0.5003
-                    t.aerial_biom = t.trunk_biom + t.bark_biom + t.branch_biom + t.leaves_biom
-                    t.roots_biom = 0.4522 * t.eest_dbh ** 1.1294
-                    t.total_biom = t.aerial_biom + t.roots_biom
-
-        if t.species == "Sb":
-            if t.cod_status == 1 or t.cod_status == 2: 
-
-                t.tree_volume = 0.000460 * t.est_dbh ** 2.0302
-
-                if t.cod_status == 1:
-                    t.merc_volume = 0
-                    t.trunk_biom = 284.2881 * (math.pi * t.est_dbh) ** 2.9646 
-                    t.bark_biom = 0.960006 * t.est_dbh ** 1.300779 
-                    t.branch_biom = 108.5769 * (math.pi * t.est_dbh) ** 1.3464
-                    t.leaves_biom = 22.5773 * (math.pi * t.est_dbh) ** 1.1690
-                    t.aerial_biom = t.trunk_biom + t.bark_biom + t.branch_biom + t.leaves_biom
-                    t.roots_biom = 0.063777 * t.est_dbh ** 2.07779
-                    t.total_biom = t.aerial_biom + t.roots_biom
-
-def wood_value_Pb(dbh, h, V):
-    V_35 = V * math.e**(-1.413 * (35 ** 4.3488) / (dbh ** 4.3188))
-    V_15 = V * math.e**(-1.413 * (15 ** 4.3488) / (dbh ** 4.3188))
-    V_7 = V * math.e**(-1.413 * (7 ** 4.3488) / (dbh ** 4.3188))
-    V___35 = V_35
-    V_35_15 = V_15 - V_35
-    V_15_7 = V_7 - V_15
-    d_2m = dbh * (-2.1823 * ( 2/h - 1) + 0.8591 * ( 2**2 / h -1))**0.5
-    if d_2m < 35 :
-        V_35_15 += V___35
-        V___35 = 0
-    Wood_Value = V___35 * 35 + V_35_15 * 30 + V_15_7 * 20
-    return Wood_Value
-
-def wood_value_Ec(dbh, h, V):
-    V_6 = V * math.e**(-1.413 * (6 ** 4.3488) / (dbh ** 4.3188))
-    V___6 = V_6
-    d_2m = dbh * (1.0988 + 0.3869 * math.log(1-(2/h)**(1/7.7840) * (1-math.e ** (-1.4409/0.3869))))
-    if d_2m < 6 :
-        V___6 = 0
-    Wood_Value = V___6 * 30
-    return Wood_Value
-    
-def stand_metrics():
+class SpeciesModels:
+    # The equations of every species, read from a JSON (or TOML) file like species_models.json.
+    # Each tree metric is compiled once into arrays with the coefficients of every species, so all the trees
+    # are calculated together whatever their species, and a new species or a regional set of coefficients
+    # is only a new file. Every equation has the form
+    #     c * (d_factor * dbh / d_divisor) ** p * h ** q * (h / dbh) ** r
+    # where p can depend on hdom: p = value if hdom > hdom_above, else hdom / (a + b * hdom)
+
+    def __init__(self, data, path=None):
+        self.path = path
+        self.version = data.get("version", 1)
+        self.fingerprint = hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+        self.aliases = data.get("aliases", {})
+        self.models = data["species"]
+        self.species = list(self.models)
+        self.height_diameter = {}
+        for code, model in self.models.items():
+            hd = model["height_diameter"]
+            self.height_diameter[code] = (hd["a"], hd["b"], hd.get("c0", 0), hd.get("c1", 1))
+        self.kernels = {name: self.compile(name) for name in EQUATION_METRICS}
+        self.roots_aerial_ratio = np.array([model.get("roots_aerial_ratio", np.nan) for model in self.models.values()])
+        self.hdom_species = [code for code, model in self.models.items() if any(isinstance(equation["p"], dict) for equation in model["equations"].values())]
 
-    # because hdom and ddom can only be calculated with alive trees valid_trees_dom is created
-    valid_trees_alive = [t for t in Tree.tree_list if t.cod_status == 1] # only takes into account alive trees
-    valid_trees_dead = [t for t in Tree.tree_list if t.cod_status == 2] # only takes into account dead trees
+    @classmethod
+    def load(cls, path):
+        try:
+            if path.endswith(".toml"):
+                import tomllib
+                with open(path, "rb") as file:
+                    return cls(tomllib.load(file), path)
+            with open(path) as file:
+                return cls(json.load(file), path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"The species models file {path} was not found, please correct and restart.")
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"The species models file {path} is not valid ({e}), please correct and restart.")
+
+    def compile(self, name):
+        # Coefficient arrays of one metric, position i is the species self.species[i] (c is NaN when it has no equation)
+        equations = [model["equations"].get(name) for model in self.models.values()]
+        kernel = {"has": np.array([equation is not None for equation in equations])}
+        for key, default in [("c", np.nan), ("d_factor", 1), ("d_divisor", 1), ("q", 0), ("r", 0)]:
+            kernel[key] = np.array([default if equation is None else equation.get(key, default) for equation in equations], dtype=float)
+        kernel["p"] = [0 if equation is None else equation["p"] for equation in equations]
+        kernel["uses_height"] = bool(np.any(kernel["q"] != 0))
+        kernel["uses_ratio"] = bool(np.any(kernel["r"] != 0))
+        return kernel
+
+    def exponents(self, p, hdom):
+        return np.array([exponent if not isinstance(exponent, dict) else exponent["value"] if hdom > exponent["hdom_above"] else hdom/(exponent["a"] + exponent["b"]*hdom) for exponent in p], dtype=float)
+
+    def hdom_exponents(self, hdom):
+        # The exponents that depend on hdom, if they do not change the trees do not have to be calculated again
+        return tuple(exponent for kernel in self.kernels.values() for exponent, p in zip(self.exponents(kernel["p"], hdom), kernel["p"]) if isinstance(p, dict))
+
+    def species_index(self, species):
+        # Position of the species of every tree in self.species (-1 for unknown species)
+        index = np.full(len(species), -1)
+        for i, code in enumerate(self.species):
+            index[species == code] = i
+        return index
+
+    def evaluate(self, name, k, dbh, height, hdom):
+        kernel = self.kernels[name]
+        if np.ndim(hdom):
+            # one hdom per tree (projections), the exponents that depend on it are calculated tree by tree
+            exponents = self.exponents(kernel["p"], 0)[k]
+            for i, exponent in enumerate(kernel["p"]):
+                if isinstance(exponent, dict):
+                    m = k == i
+                    exponents[m] = np.where(hdom[m] > exponent["hdom_above"], exponent["value"], hdom[m]/(exponent["a"] + exponent["b"]*hdom[m]))
+        else:
+            exponents = self.exponents(kernel["p"], hdom)[k]
+        values = kernel["c"][k] * ((kernel["d_factor"][k] * dbh) / kernel["d_divisor"][k]) ** exponents
+        if kernel["uses_height"]:
+            values = values * height ** kernel["q"][k]
+        if kernel["uses_ratio"]:
+            values = values * (height / dbh) ** kernel["r"][k]
+        return values
+
+    def tree_metrics(self, species, cod_status, dbh, height, hdom):
+        n = len(species)
+        metrics = {name: np.zeros(n) for name in TREE_METRICS}
+        metrics["basal_area"] = math.pi * (dbh / 100 / 2) ** 2
+
+        standing = (cod_status == 1) | (cod_status == 2)  # volume is calculated for alive and dead trees
+        alive = cod_status == 1  # the remaining metrics only for alive trees
+        index = self.species_index(species)
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            for name in EQUATION_METRICS:
+                rows = np.flatnonzero((standing if name == "tree_volume" else alive) & (index >= 0))
+                rows = rows[self.kernels[name]["has"][index[rows]]]
+                metrics[name][rows] = self.evaluate(name, index[rows], dbh[rows], height[rows], hdom[rows] if np.ndim(hdom) else hdom)
+
+            for code, model in self.models.items():
+                if "assortments" in model:
+                    m = alive & (species == code)
+                    metrics["wood_value"][m] = self.wood_value(code, dbh[m], height[m], metrics["merc_volume"][m])
+
+        # Aerial, roots and total biomass (the species without a roots equation have a roots/aerial ratio)
+        metrics["aerial_biom"][alive] = (metrics["trunk_biom"] + metrics["bark_biom"] + metrics["branch_biom"] + metrics["leaves_biom"])[alive]
+        rows = np.flatnonzero(alive & (index >= 0))
+        rows = rows[~np.isnan(self.roots_aerial_ratio[index[rows]])]
+        metrics["roots_biom"][rows] = self.roots_aerial_ratio[index[rows]] * metrics["aerial_biom"][rows]
+        metrics["total_biom"][alive] = (metrics["aerial_biom"] + metrics["roots_biom"])[alive]
+        return metrics
+
+    def assortment_volumes(self, code, dbh, h, V):
+        # Mercantile volume V split into the assortments of a species (one array per class, all the trees at once).
+        # The volume up to a top diameter t comes from the taper equation V * exp(a * t**b / dbh**c) and each class
+        # gets the volume between its top diameter and the one of the class before. A tree thinner than the top
+        # diameter of a class at 2m cannot give those logs, their volume goes to the next class (or is lost)
+        assortments = self.models[code]["assortments"]
+        taper = assortments["taper"]
+        classes = assortments["classes"]
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            above = [V * np.exp(taper["a"] * (wood_class["top_diameter"] ** taper["b"]) / (dbh ** taper["c"])) for wood_class in classes]
+            volumes = [above[0]] + [above[i] - above[i - 1] for i in range(1, len(classes))]
+            if any(wood_class.get("needs_d_2m") for wood_class in classes):
+                d_2m = self.diameter_at(assortments["d_2m"], dbh, h)
+        for i, wood_class in enumerate(classes):
+            if wood_class.get("needs_d_2m"):
+                small = d_2m < wood_class["top_diameter"]
+                if i + 1 < len(classes):
+                    volumes[i + 1] = np.where(small, volumes[i + 1] + volumes[i], volumes[i + 1])
+                volumes[i] = np.where(small, 0, volumes[i])
+        return volumes
+
+    def diameter_at(self, taper, dbh, h):
+        # Diameter of the stem at a height (2m) from its taper equation
+        x = taper["height"]
+        if taper["form"] == "quadratic":
+            return dbh * (taper["b1"] * ( x/h - 1) + taper["b2"] * ( x**2 / h -1))**0.5
+        if taper["form"] == "logarithmic":
+            c0, c1, c2, c3 = taper["c0"], taper["c1"], taper["c2"], taper["c3"]
+            return dbh * (c0 + c1 * np.log(1-(x/h)**(1/c2) * (1-math.e ** (-c3/c1))))
+        raise ValueError(f"Unknown taper equation '{taper['form']}', please correct and restart.")
+
+    def wood_value(self, code, dbh, h, V):
+        # Works both for single trees and for arrays of trees
+        classes = self.models[code]["assortments"]["classes"]
+        volumes = self.assortment_volumes(code, dbh, h, V)
+        Wood_Value = volumes[0] * classes[0]["price"]
+        for volume, wood_class in zip(volumes[1:], classes[1:]):
+            Wood_Value = Wood_Value + volume * wood_class["price"]
+        return np.asarray(Wood_Value)[()]
+
+    def set_prices(self, prices):
+        # New prices for some assortments: {species: {class name: price per m3}}
+        for code, species_prices in prices.items():
+            for wood_class in self.models[code]["assortments"]["classes"]:
+                wood_class["price"] = species_prices.get(wood_class["name"], wood_class["price"])
+        self.fingerprint = hashlib.sha256(json.dumps({"species": self.models, "aliases": self.aliases, "version": self.version}, sort_keys=True).encode()).hexdigest()
+
+    def prices(self):
+        # The current prices of every assortment, in the format of set_prices()
+        return {code: {wood_class["name"]: wood_class["price"] for wood_class in model["assortments"]["classes"]}
+                for code, model in self.models.items() if "assortments" in model}
+
+    def dominant_height(self, main_species, hdom, age, new_age):
+        # Dominant height at new_age of stands with hdom at age, from the site index curve of the species
+        # (the site index is the dominant height at the reference age). Works with arrays of stands and ages
+        curve = self.models[main_species]["site_index"]
+        A, c = curve["A"], curve["c"]
+        if curve["form"] == "power":
+            return A * (hdom/A) ** (age/new_age) ** c
+        if curve["form"] == "rational":
+            return A / (1- (1- A/hdom) * (age / new_age) ** c)
+        raise ValueError(f"Unknown site index curve '{curve['form']}', please correct and restart.")
+
+    def min_dbh(self, species):
+        # Smallest DBH (cm) of a tree of a species, aliases included ("Eu" is "Ec")
+        return self.models.get(self.aliases.get(species, species), {}).get("min_dbh", MIN_DBH)
+
+    def sdi_exponent(self, main_species):
+        return self.models.get(main_species, {}).get("sdi_exponent")
+
+    def site_index(self, main_species, hdom, age):
+        curve = self.models.get(main_species, {}).get("site_index")
+        if curve is None:
+            return 0
+        return self.dominant_height(main_species, hdom, age, curve["t_ref"])
+
+def load_species_models(path=None):
+    # Uses the species models of a file (species_models.json next to project.py by default) for every calculation
+    global MODELS
+    MODELS = SpeciesModels.load(path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "species_models.json"))
+    SPECIES[:] = MODELS.species
+    HD_COEFFICIENTS.clear()
+    HD_COEFFICIENTS.update(MODELS.height_diameter)
+    return MODELS
+
+def species_error():
+    names = [f"'{code}'" for code in SPECIES]
+    return f"There is a species value that is not acceptable (not {', '.join(names[:-1])}, or {names[-1]}), please correct and restart"
+
+def min_dbh_error(species):
+    # The species with their own minimum DBH are named in the message, e.g. "There is a Eucalyptus' DBH value..."
+    minimum = MODELS.min_dbh(species)
+    if minimum == MIN_DBH:
+        return f"There is a DBH value that's less than {minimum:g}cm, this is not considered a tree, please correct and restart."
+    genus = MODELS.models[MODELS.aliases.get(species, species)]["name"].split()[0]
+    return f"There is a {genus}' DBH value that's less than {minimum:g}cm, this is not considered a tree, please correct and restart."
+
+def calculate_missing_dbh_h(table=None):
+    if table is None:
+        table = Tree.tree_list
+    table.est_dbh, table.est_height = estimate_missing_dbh_h(table.species, table.dbh, table.height)
+
+def estimate_missing_dbh_h(species, dbh, height):
+    # Fills the missing DBH or height of every tree from the other one, one species at a time with the
+    # coefficients of HD_COEFFICIENTS, and only for the trees that have a missing value
+    est_dbh = dbh.copy()
+    est_height = height.copy()
+    missing_height = np.isnan(height)
+    missing_dbh = np.isnan(dbh)
+    if not (missing_height.any() or missing_dbh.any()):
+        return est_dbh, est_height
+
+    for code, (a, b, c0, c1) in HD_COEFFICIENTS.items():
+        is_species = species == code
+        m = missing_height & is_species
+        du = c0 + c1 * dbh[m]
+        est_height[m] = np.round(du / (a + b * du), 2)
+        m = missing_dbh & is_species
+        est_dbh[m] = np.round((-height[m]*a) / (height[m]*b - 1), 2)
+    return est_dbh, est_height
+
+def calculate_tree_metrics(table=None, hdom=None):
+    if table is None:
+        table = Tree.tree_list
+    if hdom is None:
+        hdom = getattr(Stand, "hdom", 0)
+    metrics = tree_metrics_arrays(table.species, table.cod_status, table.est_dbh, table.est_height, hdom)
+    for name, values in metrics.items():
+        setattr(table, name, values)
+
+def tree_metrics_arrays(species, cod_status, dbh, height, hdom):
+    return MODELS.tree_metrics(species, cod_status, dbh, height, hdom)
+
+MODELS = load_species_models()
+    
+def stand_metrics(age=None, table=None, stand=Stand):
+    # Without a table and a stand it works on Tree.tree_list and the Stand class, like the interactive program
+    if table is None:
+        table = Tree.tree_list
+    stand_structure(table, stand)
+    calculate_tree_metrics(table, stand.hdom)
+    stand_totals(age, table, stand)
 
-    counter = {species: 0 for species in ["Pb", "Ec", "Pm", "Sb"]}
+def stand_structure(table, stand):
+    # The first half of stand_metrics(): main species, tree density and the dominant trees, which do not need the tree metrics
 
-    for obj in valid_trees_alive:
-        if obj.species in counter:
-            counter[obj.species] += 1
+    # because hdom and ddom can only be calculated with alive trees valid_trees_dom is created
+    valid_trees_alive = table.cod_status == 1 # only takes into account alive trees
+    valid_trees_dead = table.cod_status == 2 # only takes into account dead trees
 
-    main_tree_specie = max(counter, key=counter.get)
+    counter = {species: int(np.count_nonzero(valid_trees_alive & (table.species == species))) for species in SPECIES}
 
-    if counter[main_tree_specie] / len(valid_trees_alive) >= 0.75:
-        Stand.Main_species = main_tree_specie
+    stand.Main_species = pure_stand_species(counter)
 
-    f_exp = 10000/Stand.Area
+    f_exp = 10000/stand.Area
 
-    Stand.Total = len(valid_trees_alive)
+    stand.Total = int(np.count_nonzero(valid_trees_alive))
 
     # Calculate tree density (number of trees per hectare)
-    Stand.N = len(valid_trees_alive)*f_exp
-    Stand.N_dead = len(valid_trees_dead)*f_exp
+    stand.N = stand.Total*f_exp
+    stand.N_dead = int(np.count_nonzero(valid_trees_dead))*f_exp
 
     # Calculate the number of dominant trees
-    Stand.n_dom_trees = int((Stand.Area * 100) / 10000)  # Number of dominant trees based on stand area
-
-    trees_for_dominant = []
+    stand.n_dom_trees = int((stand.Area * 100) / 10000)  # Number of dominant trees based on stand area
 
-    if Stand.Main_species != "Mixed Stand":  
-        for t in valid_trees_alive:
-            if t.species == Stand.Main_species:  
-                trees_for_dominant.append(t)    
+    if stand.Main_species != "Mixed Stand":  
+        trees_for_dominant = valid_trees_alive & (table.species == stand.Main_species)
     else:
         trees_for_dominant = valid_trees_alive
-        
-    if Stand.n_dom_trees > len(trees_for_dominant):
-        Stand.n_dom_trees = len(trees_for_dominant)
 
-    # Order alive tree heights in descending order
-    trees_sorted_by_height = sorted(trees_for_dominant, key=lambda t: t.est_height, reverse=True)
+    if stand.n_dom_trees > np.count_nonzero(trees_for_dominant):
+        stand.n_dom_trees = int(np.count_nonzero(trees_for_dominant))
 
-    # Select the top `n_dom_trees` heights
-    top_trees = trees_sorted_by_height[:Stand.n_dom_trees]
+    # Select the `n_dom_trees` tallest trees
+    top_heights, top_dbhs, _ = keep_tallest(table.est_height[trees_for_dominant], table.est_dbh[trees_for_dominant], np.flatnonzero(trees_for_dominant), stand.n_dom_trees)
 
     # Calculate H_dom: mean height of the dominant trees
-    Stand.hdom = sum(tree.est_height for tree in top_trees) / Stand.n_dom_trees
+    stand.hdom = float(top_heights.sum()) / stand.n_dom_trees
 
     # Calculate D_dom: mean diameter of the dominant trees
-    Stand.ddom = sum(tree.est_dbh for tree in top_trees) / Stand.n_dom_trees
+    stand.ddom = float(top_dbhs.sum()) / stand.n_dom_trees
 
-    calculate_tree_metrics()
+def stand_totals(age, table, stand):
+    # The second half of stand_metrics(), once the tree metrics are calculated with the hdom of the stand
+    valid_trees_alive = table.cod_status == 1
+    f_exp = 10000/stand.Area
 
-    # Calculating basal area (G)
-    G = 0
-    for tree in valid_trees_alive:
-        G += tree.basal_area
+    # Calculating basal area (G), total volume (V) and wood value. NOTA: this is the total volume with bark and stump of the entire stand.
+    G = float(table.basal_area[valid_trees_alive].sum())
+    V = float(table.tree_volume[valid_trees_alive].sum())
+    Value = float(table.wood_value[valid_trees_alive].sum())
 
-    # calculate total volume (V) NOTA: this is the total volume with bark and stump of the entire stand.
-    V = 0  # Initialize volume to 0
-    for tree in valid_trees_alive:
-        V += tree.tree_volume  # Add volume for valid trees
+    #calculate dg. need to calculate G_pov first
+    stand.G_pov = G*f_exp
+    stand.V_pov = V*f_exp
+    stand.Value_pov = Value*f_exp
 
-    # calculate total volume (V) NOTA: this is the total volume with bark and stump of the entire stand.
-    Value = 0  # Initialize volume to 0
-    for tree in valid_trees_alive:
-        Value += tree.wood_value  # Add volume for valid trees
+    stand_density_metrics(stand)
 
-    #calculate dg. need to calculate G_pov first
-    Stand.G_pov = G*f_exp
-    Stand.V_pov = V*f_exp
-    Stand.Value_pov = Value*f_exp
+    set_stand_age(stand, age)  # the interactive program asks for the age afterwards in site_index_calculation()
 
-    Stand.dg = math.sqrt((4*Stand.G_pov)/(math.pi*(Stand.N)))*100
+def pure_stand_species(counter):
+    # A stand is pure if one species has at least 75% of the alive trees
+    main_tree_specie = max(counter, key=counter.get)
+    if counter[main_tree_specie] / sum(counter.values()) >= 0.75:
+        return main_tree_specie
+    return "Mixed Stand"
 
-    # calculate wilson factor
-    Stand.Fw = 100/(Stand.hdom*math.sqrt(Stand.N))
+def stand_density_metrics(stand):
+    stand.dg = math.sqrt((4*stand.G_pov)/(math.pi*(stand.N)))*100
 
-    if Stand.Main_species == "Pb":
-        Stand.SDI = Stand.N * (Stand.dg / 25) ** 1.897
-    elif Stand.Main_species == "Ec":
-        Stand.SDI = Stand.N * (Stand.dg / 25) ** 1.6
-    elif Stand.Main_species == "Sb":
-        Stand.SDI = Stand.N * (Stand.dg / 25) ** 1.806
-    else: Stand.SDI = 0
+    # calculate wilson factor
+    stand.Fw = 100/(stand.hdom*math.sqrt(stand.N))
 
-    site_index_calculation()
+    exponent = MODELS.sdi_exponent(stand.Main_species)
+    if exponent is not None:
+        stand.SDI = stand.N * (stand.dg / 25) ** exponent
+    else: stand.SDI = 0
 
 def site_index_calculation():
     if Stand.Main_species != "Mixed Stand":
@@ -498,14 +832,105 @@ def site_index_calculation():
         Stand.Age = 0
         return
     
-    Stand.Age = int(age)
-    if Stand.Main_species == "Pb" or Stand.Main_species == "Pm":
-        Stand.Site_index = 69 * (Stand.hdom/69) ** (Stand.Age/50) ** 0.458203
-    if Stand.Main_species == "Ec": #0.4057 is an average coefficient for the regions and management options
-        Stand.Site_index = 61.1372* (Stand.hdom/61.1372) ** (Stand.Age/10) ** 0.4057
-    if Stand.Main_species == "Sb":
-        Stand.Site_index = 20.7216 / (1- (1- 20.7216/Stand.hdom) * (Stand.Age / 80) ** 1.4486)
+    set_stand_age(Stand, age)
+
+def set_stand_age(stand, age):
+    # The site index is only calculated for pure stands with a known age
+    if age is None or age == "" or stand.Main_species == "Mixed Stand":
+        stand.Age = 0
+        stand.Site_index = 0
+    else:
+        stand.Age = int(age)
+        stand.Site_index = site_index(stand.Main_species, stand.hdom, stand.Age)
+
+def site_index(main_species, hdom, age):
+    return MODELS.site_index(main_species, hdom, age)
  
+def stream_stand_metrics(file_path, area=1000, age=None, chunksize=100000, allow_extra_columns=False):
+    # Computes the stand metrics of a large file reading it in chunks, so the trees are never all in memory.
+    # Only the sums needed for the stand and the tallest trees of each species (dominant tree candidates) are kept
+    import pandas as pd
+    stand = Stand()
+    stand.Main_species = "Mixed Stand"
+    stand.Area = area
+    n_dom_trees = int((area * 100) / 10000)
+
+    counter = {species: 0 for species in SPECIES}
+    n_dead = 0
+    G = V = Value = 0
+    candidates = {group: (np.empty(0), np.empty(0), np.empty(0, dtype="int64")) for group in SPECIES + ["Mixed Stand"]}
+    tree_IDs = []
+
+    try:
+        for chunk in pd.read_csv(file_path, chunksize=chunksize):
+            if not tree_IDs:
+                validate_columns(chunk, allow_extra_columns)
+            columns, errors = validate_tree_data(chunk)
+            if errors:
+                raise ValueError(validation_report(errors))
+            tree_IDs.append(columns["tree_ID"])
+
+            species = columns["species"]
+            cod_status = columns["cod_status"]
+            est_dbh, est_height = estimate_missing_dbh_h(species, columns["dbh"], columns["height"])
+            metrics = tree_metrics_arrays(species, cod_status, est_dbh, est_height, 0)  # the biomass is not needed for the stand
+
+            alive = cod_status == 1
+            n_dead += int(np.count_nonzero(cod_status == 2))
+            G += metrics["basal_area"][alive].sum()
+            V += metrics["tree_volume"][alive].sum()
+            Value += metrics["wood_value"][alive].sum()
+
+            order = chunk.index.to_numpy()  # position in the file, to keep the same dominant trees as stand_metrics() on ties
+            for group in candidates:
+                m = alive if group == "Mixed Stand" else alive & (species == group)
+                if group != "Mixed Stand":
+                    counter[group] += int(np.count_nonzero(m))
+                heights, dbhs, orders = candidates[group]
+                candidates[group] = keep_tallest(np.concatenate([heights, est_height[m]]), np.concatenate([dbhs, est_dbh[m]]), np.concatenate([orders, order[m]]), n_dom_trees)
+    except FileNotFoundError:
+        raise FileNotFoundError("There was an error reading the file, please correct and restart.")
+
+    if not tree_IDs or sum(len(ids) for ids in tree_IDs) == 0:
+        raise ValueError("The given file is empty, please correct and restart.")
+    tree_IDs, counts = np.unique(np.concatenate(tree_IDs), return_counts=True)
+    duplicates = tree_IDs[counts > 1].tolist()
+    if len(duplicates) == 1:
+        raise ValueError(f"Tree ID {duplicates[0]} is duplicate in the table, please correct and restart.")
+    if duplicates:
+        raise ValueError(f"Tree IDs {', '.join(str(tree_ID) for tree_ID in duplicates)} are duplicate in the table, please correct and restart.")
+
+    stand.Main_species = pure_stand_species(counter)
+    f_exp = 10000/area
+    stand.Total = sum(counter.values())
+    stand.N = stand.Total*f_exp
+    stand.N_dead = n_dead*f_exp
+
+    heights, dbhs, _ = candidates[stand.Main_species]
+    stand.n_dom_trees = min(n_dom_trees, len(heights))
+    stand.hdom = heights.sum() / stand.n_dom_trees
+    stand.ddom = dbhs.sum() / stand.n_dom_trees
+
+    stand.G_pov = G*f_exp
+    stand.V_pov = V*f_exp
+    stand.Value_pov = Value*f_exp
+    stand_density_metrics(stand)
+
+    set_stand_age(stand, age)
+    return stand
+
+def keep_tallest(heights, dbhs, orders, k):
+    # Keeps the k tallest trees, the first ones in the file win on ties (like a stable sort).
+    # Only the trees at least as tall as the k-th tallest are sorted, found with a partial selection (np.partition),
+    # so the dominant trees of a big stand are found in linear time. The streaming mode calls it again on the
+    # kept candidates plus each new chunk, which merges the top k of every chunk
+    candidates = np.arange(len(heights))
+    if 0 < k < len(heights):
+        kth_height = np.partition(heights, len(heights) - k)[len(heights) - k]
+        candidates = np.flatnonzero(heights >= kth_height)
+    ranking = candidates[np.lexsort((orders[candidates], -heights[candidates]))][:k]
+    return heights[ranking], dbhs[ranking], orders[ranking]
+
 def main_menu():
     # Loop to allow repeating the menu
     print()
@@ -523,36 +948,27 @@ def main_menu():
     else:
         print("Invalid option, please try again.")
 
-def print_stand_stats():
+def print_stand_stats(stand=Stand):
     # Display results
     print("\n--- Stand Statistics ---")
     print("For more metrics please export to csv.\n")
-    print(f"Is it a Pure Stand? {Stand.Main_species}")
-    print(f"Stand Area (A): {Stand.Area/10000}ha")
-    print(f"Number of trees: {Stand.Total}")
-    print(f"Tree density (N): {Stand.N:.2f} trees/ha")
-    print(f"Dominant Height (h_dom): {Stand.hdom:.2f}m")
-    print(f"Basal Area (G/ha): {Stand.G_pov:.2f}m²")
-    print(f"Total Volume (V/ha): {Stand.V_pov:.2f}m³")
-    print(f"Total Wood Value (Value/ha): {Stand.Value_pov:.2f}€")
-    print(f"Quadratic Diameter (dg): {Stand.dg:.2f}cm")
-    print(f"Wilson Factor (Fw): {Stand.Fw:.2f}")
-    print(f"Stand Density Index (SDI): {Stand.SDI:.2f}")
-    print(f"Site Index: {Stand.Site_index:.2f}")
+    print(f"Is it a Pure Stand? {stand.Main_species}")
+    print(f"Stand Area (A): {stand.Area/10000}ha")
+    print(f"Number of trees: {stand.Total}")
+    print(f"Tree density (N): {stand.N:.2f} trees/ha")
+    print(f"Dominant Height (h_dom): {stand.hdom:.2f}m")
+    print(f"Basal Area (G/ha): {stand.G_pov:.2f}m²")
+    print(f"Total Volume (V/ha): {stand.V_pov:.2f}m³")
+    print(f"Total Wood Value (Value/ha): {stand.Value_pov:.2f}€")
+    print(f"Quadratic Diameter (dg): {stand.dg:.2f}cm")
+    print(f"Wilson Factor (Fw): {stand.Fw:.2f}")
+    print(f"Stand Density Index (SDI): {stand.SDI:.2f}")
+    print(f"Site Index: {stand.Site_index:.2f}")
 
 def print_tree_stats():
+    import pandas as pd
 
-    tree_data = {
-        "Tree ID": [tree.tree_ID for tree in Tree.tree_list],
-        "Species": [tree.species for tree in Tree.tree_list],
-        "DBH (cm)": [tree.est_dbh for tree in Tree.tree_list],
-        "Height (m)": [tree.est_height for tree in Tree.tree_list],
-        "Volume (m³)": [round(tree.tree_volume, 4) for tree in Tree.tree_list],
-        "Mercantile Volume (m³)": [round(tree.merc_volume, 4) for tree in Tree.tree_list],
-        "Wood_Value (€)": [round(tree.wood_value, 2) for tree in Tree.tree_list],
-        "Basal area (m²)": [round(tree.basal_area, 4) for tree in Tree.tree_list],
-        "Total Biomass (kg)": [round(tree.total_biom, 4) for tree in Tree.tree_list],
-    }
+    tree_data = tree_metrics_columns(Tree.tree_list, names=["Tree ID", "Species", "DBH (cm)", "Height (m)", "Volume (m³)", "Mercantile Volume (m³)", "Wood_Value (€)", "Basal area (m²)", "Total Biomass (kg)"])
 
     # Create and display the DataFrame
     tree_df = pd.DataFrame(tree_data)
@@ -562,119 +978,211 @@ def print_tree_stats():
 
 
 
-def create_histogram(trees):
-
-    # Extract the 'est_dbh' values from the Tree objects
-    dbh_values = [tree.est_dbh for tree in trees]
-    height_values = [tree.est_height for tree in trees]
-
-    max_dbh = max(tree.est_dbh for tree in trees)
-    max_height = max(tree.est_height for tree in trees)
-
-    # Generate the bins starting from 2.5 and increasing by 5 until max_dbh
-    bins_dbh = [2.5]
-    while bins_dbh[-1] < max_dbh:
-        bins_dbh.append(bins_dbh[-1] + 5)
-
-    bins_height = [2.5]
-    while bins_height[-1] < max_height:
-        bins_height.append(bins_height[-1] + 5)
-
-    # Create dynamic labels
-    labels_dbh = [f"[{bins_dbh[i]},{bins_dbh[i+1]}[" for i in range(len(bins_dbh)-1)]
-    labels_height = [f"[{bins_height[i]},{bins_height[i+1]}[" for i in range(len(bins_height)-1)]
-
-    # Group the data into diameter and height classes
-    diameter_classes = pd.cut(dbh_values, bins=bins_dbh, labels=labels_dbh, right=False)
-    height_classes = pd.cut(height_values, bins=bins_height, labels=labels_height, right=False)
-
-    # Count the frequencies for each class
-    frequencies_dbh = pd.Series(diameter_classes).value_counts(sort=False)
-    frequencies_height = pd.Series(height_classes).value_counts(sort=False)
+def create_histogram(trees, headless=False):
+    frequencies_dbh = class_distribution(trees, "dbh")["Trees"]
+    frequencies_height = class_distribution(trees, "height")["Trees"]
 
     # Create DBH histogram
-    fig_dbh, ax_dbh = plt.subplots(figsize=(10, 6))
-    ax_dbh.bar(frequencies_dbh.index, frequencies_dbh.values, color="skyblue", edgecolor="black")
-    ax_dbh.set_xlabel("Diameter Class (cm)", fontsize=12)
-    ax_dbh.set_ylabel("Frequency", fontsize=12)
-    ax_dbh.set_title("Histogram of Tree Diameter Classes", fontsize=14)
-    ax_dbh.tick_params(axis='x', rotation=45)
+    fig_dbh, ax_dbh = new_figure(headless)
+    draw_histogram(ax_dbh, frequencies_dbh, "dbh")
 
     # Create Height histogram
-    fig_height, ax_height = plt.subplots(figsize=(10, 6))
-    ax_height.bar(frequencies_height.index, frequencies_height.values, color="skyblue", edgecolor="black")
-    ax_height.set_xlabel("Height Class (m)", fontsize=12)
-    ax_height.set_ylabel("Frequency", fontsize=12)
-    ax_height.set_title("Histogram of Tree Height Classes", fontsize=14)
-    ax_height.tick_params(axis='x', rotation=45)
+    fig_height, ax_height = new_figure(headless)
+    draw_histogram(ax_height, frequencies_height, "height")
 
     if fig_dbh and fig_height:
         return fig_dbh, fig_height
     else:
         raise ValueError("There was an error calculating the plots, please correct and restart.")
 
-def export_plots_to_png(fig_dbh, fig_height):
+def draw_histogram(ax, frequencies, variable):
+    ax.bar(list(frequencies.index), frequencies.values, color="skyblue", edgecolor="black")
+    if variable == "dbh":
+        ax.set_xlabel("Diameter Class (cm)", fontsize=12)
+        ax.set_title("Histogram of Tree Diameter Classes", fontsize=14)
+    else:
+        ax.set_xlabel("Height Class (m)", fontsize=12)
+        ax.set_title("Histogram of Tree Height Classes", fontsize=14)
+    ax.set_ylabel("Frequency", fontsize=12)
+    ax.tick_params(axis='x', rotation=45)
+
+def class_counts(values, width=5, start=2.5, groups=None, n_groups=1):
+    # Counts the values in classes of the same width ([2.5,7.5[, [7.5,12.5[, ...) for every group at once.
+    # Returns the class limits and a (groups x classes) table of counts
+    values = np.asarray(values, dtype=float)
+    valid = values >= start  # also leaves out the missing values
+    classes = ((values[valid] - start) // width).astype("int64")
+    n_classes = int(classes.max()) + 1 if len(classes) else 0
+    groups = np.zeros(len(classes), dtype="int64") if groups is None else np.asarray(groups)[valid]
+    counts = np.bincount(groups * n_classes + classes, minlength=n_groups * n_classes).reshape(n_groups, n_classes)
+    return start + width * np.arange(n_classes + 1), counts
+
+def class_distribution(trees, variable="dbh", width=5, start=2.5, by=None):
+    # Table with the number of trees in each diameter ("dbh") or height ("height") class, as data (no figure).
+    # by="species", by="cod_status" or by=["species", "cod_status"] gives one column for each species/status
+    import pandas as pd
+    if not isinstance(trees, TreeTable):
+        trees = TreeTable.from_trees(trees)
+    values = trees.est_dbh if variable == "dbh" else trees.est_height
+
+    if by is None:
+        columns = pd.Index(["Trees"])
+        edges, counts = class_counts(values, width, start)
+    else:
+        by = [by] if isinstance(by, str) else list(by)
+        keys = pd.MultiIndex.from_arrays([getattr(trees, name) for name in by], names=by)
+        codes, columns = pd.factorize(keys, sort=True)
+        if len(by) == 1:
+            columns = columns.get_level_values(0)
+        edges, counts = class_counts(values, width, start, codes, len(columns))
+
+    labels = [f"[{lower:g},{upper:g}[" for lower, upper in zip(edges[:-1], edges[1:])]
+    index = pd.Index(labels, name="Diameter Class (cm)" if variable == "dbh" else "Height Class (m)")
+    return pd.DataFrame(counts.T, index=index, columns=columns)
+
+chart_template = None  # figure reused by render_stand_charts() in each process
+
+def render_stand_charts(job):
+    # Draws the DBH and height histograms of one stand from its class tables and saves them as
+    # <name>_dbh_classes.png and <name>_height_classes.png. Only the Agg backend is used (no windows).
+    # With reuse_figure the same figure is cleared and drawn again for every chart, which avoids
+    # setting up a new matplotlib figure each time
+    global chart_template
+    paths = []
+    for variable in ["dbh", "height"]:
+        if job.get("reuse_figure", True):
+            if chart_template is None:
+                chart_template = new_figure(headless=True)
+            fig, ax = chart_template
+            ax.clear()
+        else:
+            fig, ax = new_figure(headless=True)
+        draw_histogram(ax, job[variable], variable)
+        path = os.path.join(job["out_dir"], f"{job['name']}_{variable}_classes.png")
+        fig.savefig(path, dpi=job.get("dpi", 200), bbox_inches="tight")
+        if not job.get("reuse_figure", True):
+            fig.clear()  # frees the memory of the drawing straight away
+        paths.append(path)
+    return paths
+
+def export_stand_charts(stands, out_dir="charts", workers=None, dpi=200, reuse_figure=True):
+    # Exports the histograms of many stands in parallel. stands is a dict {name: TreeTable or InventoryAnalysis}.
+    # Only the small class tables are sent to the worker processes, not the trees
+    from concurrent.futures import ProcessPoolExecutor
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for name, trees in stands.items():
+        if isinstance(trees, InventoryAnalysis):
+            trees = trees.trees
+        jobs.append({
+            "name": name,
+            "dbh": class_distribution(trees, "dbh")["Trees"],
+            "height": class_distribution(trees, "height")["Trees"],
+            "out_dir": out_dir,
+            "dpi": dpi,
+            "reuse_figure": reuse_figure,
+        })
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 4))
+        return {job["name"]: paths for job, paths in zip(jobs, executor.map(render_stand_charts, jobs, chunksize=chunksize))}
+
+def new_figure(headless=False):
+    # Headless figures are drawn with the Agg backend only (no window, no pyplot), for exporting to png
+    if headless:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(10, 6))
+        return fig, fig.subplots()
+    import matplotlib.pyplot as plt
+    return plt.subplots(figsize=(10, 6))
+
+def export_plots_to_png(fig_dbh, fig_height, out_dir="."):
     try:
-        fig_dbh.savefig("chart_tree_dbh_classes.png", dpi=200, bbox_inches="tight")
-        fig_height.savefig("chart_tree_height_classes.png", dpi=200, bbox_inches="tight")
+        fig_dbh.savefig(os.path.join(out_dir, "chart_tree_dbh_classes.png"), dpi=200, bbox_inches="tight")
+        fig_height.savefig(os.path.join(out_dir, "chart_tree_height_classes.png"), dpi=200, bbox_inches="tight")
         print("\nPlots successfully exported as PNG images:\n"
               " - chart_tree_dbh_classes.png\n"
               " - chart_tree_height_classes.png\n")
     except Exception as e:
         print(f"\nFailed to export plots: {e}\n")
 
-def export_to_csv():
+def tree_metrics_columns(table, rounded=True, names=None):
+    # Builds the output columns straight from the table arrays, one pass per column.
+    # The text tables are rounded, the Parquet/Feather files keep the full values
+    columns = {}
+    for name, attribute, decimals in TREE_EXPORT_COLUMNS:
+        if names is None or name in names:
+            values = getattr(table, attribute)
+            if rounded and decimals is None and values.dtype.kind == "f" and (values == np.round(values)).all():
+                values = values.astype(np.int64)  # DBH and heights that are all whole numbers are written like in the file (12, not 12.0)
+            columns[name] = values.round(decimals) if rounded and decimals is not None else values
+    return columns
+
+def wood_assortments(table=None):
+    # Volume, price and value of each assortment of every alive tree of the species with wood value (one row per tree and assortment)
+    import pandas as pd
+    if table is None:
+        table = Tree.tree_list
+    frames = []
+    for code, model in MODELS.models.items():
+        if "assortments" not in model:
+            continue
+        m = (table.cod_status == 1) & (table.species == code)
+        volumes = MODELS.assortment_volumes(code, table.est_dbh[m], table.est_height[m], table.merc_volume[m])
+        for volume, wood_class in zip(volumes, model["assortments"]["classes"]):
+            frames.append(pd.DataFrame({
+                "Tree ID": table.tree_ID[m],
+                "Species": code,
+                "Assortment": wood_class["name"],
+                "Volume (m³)": volume,
+                "Price (€/m³)": wood_class["price"],
+                "Value (€)": volume * wood_class["price"],
+            }))
+    if not frames:
+        return pd.DataFrame(columns=["Tree ID", "Species", "Assortment", "Volume (m³)", "Price (€/m³)", "Value (€)"])
+    return pd.concat(frames, ignore_index=True).sort_values(["Tree ID", "Assortment"], kind="stable", ignore_index=True)
+
+def tree_metrics_table(table=None, rounded=True):
     # Prepare data for the tree metrics DataFrame
-    data = {
-        "Tree ID": [tree.tree_ID for tree in Tree.tree_list],
-        "Species": [tree.species for tree in Tree.tree_list],
-        "COD_Status": [tree.cod_status for tree in Tree.tree_list],
-        "DBH (cm)": [tree.est_dbh for tree in Tree.tree_list],
-        "Height (m)": [tree.est_height for tree in Tree.tree_list],
-        "Volume (m³)": [round(tree.tree_volume, 4) for tree in Tree.tree_list],
-        "Mercantile Volume (m³)": [round(tree.merc_volume, 4) for tree in Tree.tree_list],
-        "Wood_Value (€)": [round(tree.wood_value, 2) for tree in Tree.tree_list],
-        "Basal area (m²)": [round(tree.basal_area, 4) for tree in Tree.tree_list],
-        "Trunk Biomass (kg)": [round(tree.trunk_biom, 4) for tree in Tree.tree_list],
-        "Bark Biomass (kg)": [round(tree.bark_biom, 4) for tree in Tree.tree_list],
-        "Branches Biomass (kg)": [round(tree.branch_biom, 4) for tree in Tree.tree_list],
-        "Needles Biomass (kg)": [round(tree.leaves_biom, 4) for tree in Tree.tree_list],
-        "Aerial Biomass (kg)": [round(tree.aerial_biom, 4) for tree in Tree.tree_list],
-        "Roots Biomass (kg)": [round(tree.roots_biom, 4) for tree in Tree.tree_list],
-        "Total Biomass (kg)": [round(tree.total_biom, 4) for tree in Tree.tree_list],
-    }
-    metrics_df = pd.DataFrame(data)
-
-        # Prepare data for the DataFrame
+    import pandas as pd
+    if table is None:
+        table = Tree.tree_list
+    return pd.DataFrame(tree_metrics_columns(table, rounded))
+
+def stand_metrics_table(stand=Stand):
+    # Prepare data for the stand metrics DataFrame (one row)
+    import pandas as pd
     stand_data = {
-        "Pure Stand": [Stand.Main_species],
-        "Area (ha)": [round(Stand.Area/10000, 5)],
-        "Stand Age (yr)": [Stand.Age],
-        "Number of Trees": [Stand.Total],
-        "Tree Density (trees/ha)": [round(Stand.N, 4)],
-        "Dead Tree Density (trees/ha)": [round(Stand.N_dead, 4)],
-        "Number of Dominant Trees": [Stand.n_dom_trees],
-        "Dominant Height (m)": [round(Stand.hdom, 4)],
-        "Dominant Diametre (cm)": [round(Stand.ddom, 4)],
-        "Total Basal Area (m²/ha)": [round(Stand.G_pov, 4)],
-        "Total Volume (m³/ha)": [round(Stand.V_pov, 4)],
-        "Total Wood Value (€/ha)": [round(Stand.Value_pov, 4)],
-        "Mean Quadratic Diameter (cm)": [round(Stand.dg, 4)],
-        "Wilson Factor": [round(Stand.Fw, 4)],
-        "Site Index": [round(Stand.Site_index, 4)],
-        "Stand Density Index": [round(Stand.SDI, 4)],        
+        "Pure Stand": [stand.Main_species],
+        "Area (ha)": [round(stand.Area/10000, 5)],
+        "Stand Age (yr)": [stand.Age],
+        "Number of Trees": [stand.Total],
+        "Tree Density (trees/ha)": [round(stand.N, 4)],
+        "Dead Tree Density (trees/ha)": [round(stand.N_dead, 4)],
+        "Number of Dominant Trees": [stand.n_dom_trees],
+        "Dominant Height (m)": [round(stand.hdom, 4)],
+        "Dominant Diametre (cm)": [round(stand.ddom, 4)],
+        "Total Basal Area (m²/ha)": [round(stand.G_pov, 4)],
+        "Total Volume (m³/ha)": [round(stand.V_pov, 4)],
+        "Total Wood Value (€/ha)": [round(stand.Value_pov, 4)],
+        "Mean Quadratic Diameter (cm)": [round(stand.dg, 4)],
+        "Wilson Factor": [round(stand.Fw, 4)],
+        "Site Index": [round(stand.Site_index, 4)],
+        "Stand Density Index": [round(stand.SDI, 4)],        
     }
 
-    # Create and display the DataFrame
-    stand_df = pd.DataFrame(stand_data)
+    return pd.DataFrame(stand_data)
+
+def export_to_csv(table=None, stand=Stand, tree_path="metrics_tree.csv", stand_path="metrics_stand.csv"):
+    metrics_df = tree_metrics_table(table)
+    stand_df = stand_metrics_table(stand)
 
     # Write to CSV
     try:
-        with open("metrics_tree.csv", "w") as f:
+        with open(tree_path, "w") as f:
             f.truncate(0) 
             metrics_df.to_csv(f, index=False, encoding='utf-8')
         
-        with open("metrics_stand.csv", "w") as f:
+        with open(stand_path, "w") as f:
             f.truncate(0) 
             stand_df.to_csv(f, index=False, encoding='utf-8')
 
@@ -682,16 +1190,1047 @@ def export_to_csv():
     except Exception as e:
         print(f"\nFailed to export data: {e}\n")
 
-def main():
+def write_table(df, path, file_format="csv", compression="zstd"):
+    # Writes a table as csv, or as a typed and compressed Parquet or Feather (Arrow IPC) file.
+    # path has no extension, the one of the format is added. Returns the path of the file
+    if file_format not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format '{file_format}', please use one of: {', '.join(TABLE_FORMATS)}.")
+    path += TABLE_FORMATS[file_format]
+    if file_format == "csv":
+        df.to_csv(path, index=False, encoding="utf-8")
+        return path
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("Parquet and Feather files need the pyarrow library, please install it (pip install pyarrow).")
+    if "Species" in df:
+        df = df.assign(Species=df["Species"].astype("category"))  # stored once per species, not once per tree
+    if file_format == "parquet":
+        df.to_parquet(path, index=False, compression=compression)
+    else:
+        df.to_feather(path, compression=compression)
+    return path
+
+def export_tables(table=None, stand=Stand, out_dir=".", file_format="parquet", compression="zstd"):
+    # Same tables as export_to_csv() in a columnar format: metrics_tree.parquet and metrics_stand.parquet (or .feather)
+    tree_path = write_table(tree_metrics_table(table, rounded=file_format == "csv"), os.path.join(out_dir, "metrics_tree"), file_format, compression)
+    stand_path = write_table(stand_metrics_table(stand), os.path.join(out_dir, "metrics_stand"), file_format, compression)
+    return tree_path, stand_path
+
+def analyse_stand(file_path, area=1000, age=None, allow_extra_columns=False, cache=None, profiler=None):
+    # The whole analysis of one stand without any questions, returns an InventoryAnalysis.
+    # With a ResultCache, a file that was already analysed with the same area and age is not analysed again
+    if cache is None:
+        return InventoryAnalysis.from_csv(file_path, area, age, allow_extra_columns, profiler)
+    with profile_stage(profiler, "read_cache") as stage:
+        key = cache.key(file_path, area, age, allow_extra_columns)  # hashes the whole file, only once
+        analysis = cache.get(key)
+        stage["rows"] = 0 if analysis is None else len(analysis.trees)
+    if analysis is None:
+        analysis = InventoryAnalysis.from_csv(file_path, area, age, allow_extra_columns, profiler)
+        cache.put(key, analysis)
+    return analysis
+
+def analyse_trees(df, area=1000, age=None, allow_extra_columns=False):
+    # Same as analyse_stand() for tree data that is already in a DataFrame
+    validate_columns(df, allow_extra_columns)
+    trees = tree_table_from_dataframe(df)
+    if not trees:
+        raise ValueError("The given file is empty, please correct and restart.")
+    analysis = InventoryAnalysis(trees, area)
+    analysis.calculate_missing_dbh_h()
+    analysis.stand_metrics(age)
+    return analysis
+
+class InventoryAnalysis:
+    # One stand analysis that owns its trees and its Stand results, instead of using Tree.tree_list and the Stand class,
+    # so many stands can be analysed at the same time in one program (threads, a server, ...)
+
+    def __init__(self, trees=None, area=1000):
+        self.trees = TreeTable() if trees is None else trees
+        self.stand = Stand()
+        self.stand.Main_species = "Mixed Stand"
+        self.stand.Area = area
+        self.age = None
+        self._totals = None  # running sums used by update_trees(), built the first time it is called
+        self._dominant = None
+
+    @classmethod
+    def from_csv(cls, file_path, area=1000, age=None, allow_extra_columns=False, profiler=None):
+        analysis = cls(area=area)
+        with profile_stage(profiler, "read_data") as stage:
+            analysis.read_data(file_path, allow_extra_columns)
+            stage["rows"] = len(analysis.trees)
+        with profile_stage(profiler, "calculate_missing_dbh_h", len(analysis.trees)):
+            analysis.calculate_missing_dbh_h()
+        with profile_stage(profiler, "stand_metrics", len(analysis.trees)):
+            analysis.stand_metrics(age)
+        return analysis
+
+    def read_data(self, file_path, allow_extra_columns=False):
+        self.trees = read_tree_table(file_path, allow_extra_columns, verbose=False)
+
+    def calculate_missing_dbh_h(self):
+        calculate_missing_dbh_h(self.trees)
+
+    def stand_metrics(self, age=None):
+        stand_metrics(age, self.trees, self.stand)
+        self.age = age
+        self._totals = None
+        self._dominant = None
+
+    def update_trees(self, changes=None, removed=()):
+        # Applies corrections to a stand that was already analysed, without starting again.
+        # changes is a DataFrame like the input file: trees with a known Tree ID replace the old ones, the others are added.
+        # removed is a list of Tree IDs. Only the changed trees are estimated and calculated, the stand sums are updated
+        # with the difference and the dominant trees are only selected again when a change can reach them
+        table = self.trees
+        if self._totals is None:
+            self._totals = self._sums(np.arange(len(table)))
+
+        rows = [table.row_of(tree_ID) for tree_ID in removed]
+        unknown = [tree_ID for tree_ID, row in zip(removed, rows) if row is None]
+        if len(unknown) == 1:
+            raise ValueError(f"Tree ID {unknown[0]} is not in the table, please correct and restart.")
+        if unknown:
+            raise ValueError(f"Tree IDs {', '.join(str(tree_ID) for tree_ID in unknown)} are not in the table, please correct and restart.")
+
+        if changes is not None:
+            validate_columns(changes, False)
+            new = tree_table_from_dataframe(changes)
+        else:
+            new = TreeTable()
+        calculate_missing_dbh_h(new)
+
+        self._add_sums(self._sums(rows), -1)
+        table.delete(rows)
+        touched = set(removed)
+
+        replaced = np.array([-1 if row is None else row for row in map(table.row_of, new.tree_ID.tolist())], dtype="int64")
+        old = replaced >= 0
+        self._add_sums(self._sums(replaced[old]), -1)
+        touched.update(new.tree_ID.tolist())
+        table.replace_rows(replaced[old], new.take(old))
+        first_added = len(table)
+        table.extend(new.take(~old))
+        changed = np.concatenate([replaced[old], np.arange(first_added, len(table))])
+
+        hdom = self.stand.hdom
+        self._update_dominant(changed, touched)
+        metrics = tree_metrics_arrays(table.species[changed], table.cod_status[changed], table.est_dbh[changed], table.est_height[changed], self.stand.hdom)
+        for name, values in metrics.items():
+            getattr(table, name)[changed] = values
+        if MODELS.hdom_exponents(hdom) != MODELS.hdom_exponents(self.stand.hdom) and np.isin(table.species, MODELS.hdom_species).any():
+            calculate_tree_metrics(table, self.stand.hdom)  # the Ec biomass of every tree changes with hdom
+        self._add_sums(self._sums(changed), 1)
+
+        stand = self.stand
+        f_exp = 10000/stand.Area
+        stand.Total = sum(self._totals["counter"].values())
+        stand.N = stand.Total*f_exp
+        stand.N_dead = self._totals["n_dead"]*f_exp
+        stand.G_pov = self._totals["G"]*f_exp
+        stand.V_pov = self._totals["V"]*f_exp
+        stand.Value_pov = self._totals["Value"]*f_exp
+        stand_density_metrics(stand)
+        set_stand_age(stand, self.age)
+
+    def _sums(self, rows):
+        # What some trees add to the stand: alive trees per species, dead trees, basal area, volume and value
+        table = self.trees
+        alive = table.cod_status[rows] == 1
+        species = table.species[rows][alive]
+        return {
+            "counter": {code: int(np.count_nonzero(species == code)) for code in SPECIES},
+            "n_dead": int(np.count_nonzero(table.cod_status[rows] == 2)),
+            "G": float(table.basal_area[rows][alive].sum()),
+            "V": float(table.tree_volume[rows][alive].sum()),
+            "Value": float(table.wood_value[rows][alive].sum()),
+        }
+
+    def _add_sums(self, sums, sign):
+        for code in SPECIES:
+            self._totals["counter"][code] += sign*sums["counter"][code]
+        for name in ["n_dead", "G", "V", "Value"]:
+            self._totals[name] += sign*sums[name]
+
+    def _update_dominant(self, changed, touched):
+        # The dominant trees stay the same when the main species and their number do not change, none of them
+        # was edited or removed and every changed tree is shorter than the shortest of them
+        table = self.trees
+        stand = self.stand
+        stand.Main_species = pure_stand_species(self._totals["counter"])
+        eligible = table.cod_status == 1
+        if stand.Main_species != "Mixed Stand":
+            eligible &= table.species == stand.Main_species
+        n_dom_trees = min(int((stand.Area * 100) / 10000), int(np.count_nonzero(eligible)))
+
+        if self._dominant is not None:
+            main_species, dominant_IDs, shortest = self._dominant
+            if (main_species == stand.Main_species and n_dom_trees == stand.n_dom_trees and not touched & dominant_IDs
+                    and np.all(table.est_height[changed][eligible[changed]] < shortest)):
+                return
+
+        heights, dbhs, orders = keep_tallest(table.est_height[eligible], table.est_dbh[eligible], np.flatnonzero(eligible), n_dom_trees)
+        stand.n_dom_trees = n_dom_trees
+        stand.hdom = float(heights.sum()) / n_dom_trees
+        stand.ddom = float(dbhs.sum()) / n_dom_trees
+        self._dominant = (stand.Main_species, set(table.tree_ID[orders].tolist()), heights.min())
+
+    def tree_metrics_table(self, rounded=True):
+        return tree_metrics_table(self.trees, rounded)
+
+    def stand_metrics_table(self):
+        return stand_metrics_table(self.stand)
+
+    def export_to_csv(self, tree_path="metrics_tree.csv", stand_path="metrics_stand.csv"):
+        export_to_csv(self.trees, self.stand, tree_path, stand_path)
+
+    def export_tables(self, out_dir=".", file_format="parquet", compression="zstd"):
+        return export_tables(self.trees, self.stand, out_dir, file_format, compression)
+
+    def thinning_scenarios(self, scenarios):
+        return thinning_scenarios(self, scenarios)
+
+    def uncertainty(self, replicates=1000, coefficient_cv=0.05, area_cv=0.0, percentiles=(2.5, 50, 97.5), seed=None, workers=None):
+        return stand_uncertainty(self, replicates, coefficient_cv, area_cv, percentiles, seed, workers)
+
+GROWTH_COLUMNS = ["Dominant Height (m)", "Tree Density (trees/ha)", "Total Basal Area (m²/ha)", "Total Volume (m³/ha)", "Total Wood Value (€/ha)", "Total Biomass (t/ha)"]
+
+def project_growth(analyses, years=30, step=1, scenarios=None, max_cells=2000000):
+    # Projects analysed stands (a list or a {name: InventoryAnalysis} dict) forward in time, one row per stand, scenario and age.
+    # The dominant height of every stand and year comes from the site index curve of its main species, so only the pure
+    # stands with an age and a site index curve are projected. The height and the DBH of each tree grow like hdom (the trees
+    # keep their height relative to hdom and their slenderness), and the volume, value and biomass come from the equations of stand_metrics(),
+    # evaluated for all the trees of many stands and all the years at once (at most max_cells trees x years per batch).
+    # scenarios is {name: {"mortality": annual rate}}, the mortality only scales the sums so the trees are calculated once
+    import pandas as pd
+    if not isinstance(analyses, dict):
+        analyses = dict(enumerate(analyses))
+    scenarios = scenarios or {"Base": {"mortality": 0.0}}
+    offsets = np.arange(0, years + 1, step)
+    frames = []
+    batch = []
+    cells = 0
+    for name, analysis in analyses.items():
+        stand = analysis.stand
+        if not stand.Age or "site_index" not in MODELS.models.get(stand.Main_species, {}):
+            continue
+        batch.append((name, analysis))
+        cells += len(analysis.trees) * len(offsets)
+        if cells >= max_cells:
+            frames.append(growth_batch(batch, offsets, scenarios))
+            batch = []
+            cells = 0
+    if batch:
+        frames.append(growth_batch(batch, offsets, scenarios))
+    if not frames:
+        return pd.DataFrame(columns=["Stand", "Scenario", "Age", *GROWTH_COLUMNS])
+    return pd.concat(frames, ignore_index=True)
+
+def growth_batch(stands, offsets, scenarios):
+    # The projection of a group of stands, with the trees as rows and the years as columns
+    import pandas as pd
+    n_stands = len(stands)
+    n_years = len(offsets)
+    ages = np.array([analysis.stand.Age for _, analysis in stands])[:, None] + offsets
+    hdom = np.empty((n_stands, n_years))
+    columns = {"species": [], "dbh": [], "height": [], "group": [], "f_exp": []}
+    for s, (_, analysis) in enumerate(stands):
+        stand = analysis.stand
+        table = analysis.trees
+        hdom[s] = MODELS.dominant_height(stand.Main_species, stand.hdom, stand.Age, ages[s])
+        alive = table.cod_status == 1
+        columns["species"].append(table.species[alive])
+        columns["dbh"].append(table.est_dbh[alive])
+        columns["height"].append(table.est_height[alive])
+        columns["group"].append(np.full(np.count_nonzero(alive), s))
+        columns["f_exp"].append(np.full(np.count_nonzero(alive), 10000/stand.Area))
+    species, dbh, height, group, f_exp = (np.concatenate(values) for values in columns.values())
+
+    growth = hdom[group] / hdom[group, :1]
+    heights = height[:, None] * growth
+    dbhs = dbh[:, None] * growth
+    metrics = MODELS.tree_metrics(np.repeat(species, n_years), np.ones(dbhs.size, dtype="int8"), dbhs.ravel(), heights.ravel(), hdom[group].ravel())
+    cells = (group[:, None] * n_years + np.arange(n_years)).ravel()
+    weights = np.repeat(f_exp, n_years)
+    sums = {name: np.bincount(cells, metrics[name] * weights, n_stands * n_years).reshape(n_stands, n_years) for name in ["basal_area", "tree_volume", "wood_value", "total_biom"]}
+    N = np.bincount(group, f_exp, n_stands)[:, None]
+
+    frames = []
+    for scenario, options in scenarios.items():
+        survival = (1 - options.get("mortality", 0.0)) ** offsets
+        frames.append(pd.DataFrame({
+            "Stand": np.repeat([name for name, _ in stands], n_years),
+            "Scenario": scenario,
+            "Age": ages.ravel(),
+            "Dominant Height (m)": hdom.ravel(),
+            "Tree Density (trees/ha)": (N * survival).ravel(),
+            "Total Basal Area (m²/ha)": (sums["basal_area"] * survival).ravel(),
+            "Total Volume (m³/ha)": (sums["tree_volume"] * survival).ravel(),
+            "Total Wood Value (€/ha)": (sums["wood_value"] * survival).ravel(),
+            "Total Biomass (t/ha)": (sums["total_biom"] * survival / 1000).ravel(),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+def thinning_scenarios(analysis, scenarios):
+    # Stand metrics after each of many thinnings of an analysed stand, one row per scenario with the removed trees,
+    # basal area, volume and wood value (per hectare) and the stand_metrics_table() columns of the remaining stand.
+    # A scenario is a dict with a "method" ("below" removes the thinnest trees first, "above" the thickest), optionally
+    # the "species" that can be removed, and one of "removal" (fraction of those trees), "target_sdi" or "target_fw".
+    # "Target Reached" is False when the target cannot be reached even removing every candidate tree but one (then
+    # nothing is removed), or when the removal fraction would take every alive tree (one stays).
+    # The trees are never calculated again: each scenario is a mask over the tree metrics of the analysis
+    import pandas as pd
+    orders = {}
+    rows = []
+    for i, scenario in enumerate(scenarios):
+        key = (scenario.get("method", "below"), tuple(sorted(scenario.get("species") or [])))
+        if key not in orders:
+            orders[key] = thinning_order(analysis, *key)
+        stand, removed, reached = thin(analysis, scenario, orders[key])
+        rows.append({"Scenario": scenario.get("name", i), "Target Reached": reached, **removed_wood(analysis, removed), **stand_metrics_table(stand).iloc[0].to_dict()})
+    return pd.DataFrame(rows)
+
+def thin(analysis, scenario, order=None):
+    # Applies one thinning scenario (see thinning_scenarios()), returns the remaining Stand, the mask of the removed trees
+    # and whether the target was reached (at least one alive tree always stays)
+    if order is None:
+        order = thinning_order(analysis, scenario.get("method", "below"), scenario.get("species"))
+    targets = [name for name in ["removal", "target_sdi", "target_fw"] if scenario.get(name) is not None]
+    if len(targets) != 1:
+        raise ValueError("A thinning scenario needs one of 'removal', 'target_sdi' or 'target_fw', please correct and restart.")
+    table = analysis.trees
+    n_alive = int(np.count_nonzero(table.cod_status == 1))
+    max_k = min(len(order), n_alive - 1)  # at least one tree stays
+
+    if targets[0] == "removal":
+        k = min(int(round(scenario["removal"] * len(order))), max_k)
+    elif targets[0] == "target_sdi":
+        if MODELS.sdi_exponent(analysis.stand.Main_species) is None:
+            raise ValueError("The stand has no SDI (a mixed stand or a species without an SDI exponent), use 'removal' or 'target_fw', please correct and restart.")
+        k = int(np.argmax(thinned_sdi(analysis, order[:max_k]) <= scenario["target_sdi"]))  # 0 if it is never reached
+    else:
+        # the Wilson factor does not always grow with every removed tree (the main species and the dominant trees
+        # can change), so every number of trees is evaluated and the first one that reaches the target wins
+        k = int(np.argmax(thinned_fw(analysis, order[:max_k]) >= scenario["target_fw"]))  # 0 if it is never reached
+
+    removed = removal_mask(table, order[:k])
+    stand = thinned_stand(analysis, removed)
+    if targets[0] == "removal":
+        return stand, removed, k == int(round(scenario["removal"] * len(order)))
+    if targets[0] == "target_sdi":
+        # a thinning that leaves a mixed stand has no SDI, it does not reach the target
+        reached = MODELS.sdi_exponent(stand.Main_species) is not None and stand.SDI <= scenario["target_sdi"]
+    else:
+        reached = stand.Fw >= scenario["target_fw"]
+    if not reached:
+        removed = removal_mask(table, order[:0])  # a target that cannot be reached removes nothing
+        stand = thinned_stand(analysis, removed)
+    return stand, removed, bool(reached)
+
+def thinned_species(analysis, order):
+    # The alive trees of every species after removing the first k trees of order, for every k from 0 to len(order),
+    # with the main species (index in SPECIES) and whether the stand is pure, like pure_stand_species()
+    table = analysis.trees
+    alive = table.cod_status == 1
+    codes = np.array(SPECIES)
+    removed = np.zeros((len(order) + 1, len(codes)))
+    removed[1:] = np.cumsum(table.species[order][:, None] == codes, axis=0)
+    counts = np.array([np.count_nonzero(alive & (table.species == code)) for code in SPECIES]) - removed
+    main = counts.argmax(axis=1)  # the first species of SPECIES on ties, like pure_stand_species()
+    pure = counts[np.arange(len(counts)), main] / counts.sum(axis=1) >= 0.75
+    return counts, main, pure
+
+def thinned_sdi(analysis, order):
+    # The SDI of the stand after removing the first k trees of order, for every k from 0 to len(order) at once.
+    # Like thinned_stand(), the exponent is the one of the main species of the remaining trees. The SDI is NaN when it is
+    # not defined (a mixed stand or a species without an SDI exponent), so no target is reached by making the stand mixed
+    table = analysis.trees
+    alive = table.cod_status == 1
+    f_exp = 10000/analysis.stand.Area
+    counts, main, pure = thinned_species(analysis, order)
+    exponents = np.array([np.nan if MODELS.sdi_exponent(code) is None else MODELS.sdi_exponent(code) for code in SPECIES])
+    exponent = np.where(pure, exponents[main], np.nan)
+
+    N = counts.sum(axis=1) * f_exp
+    G = (table.basal_area[alive].sum() - np.concatenate([[0], np.cumsum(table.basal_area[order])])) * f_exp
+    return N * (np.sqrt((4*G)/(math.pi*N))*100 / 25) ** exponent
+
+def thinned_fw(analysis, order):
+    # The Wilson factor of the stand after removing the first k trees of order, for every k from 0 to len(order).
+    # The dominant trees are the tallest ones of the main species (of all the species in a mixed stand), like thinned_stand().
+    # For every species that is the main one at some k, its trees are sorted by height once and the dominant trees are
+    # walked down the list: a removed dominant tree is replaced by the next tallest one still standing
+    table = analysis.trees
+    alive = table.cod_status == 1
+    f_exp = 10000/analysis.stand.Area
+    counts, main, pure = thinned_species(analysis, order)
+    group = np.where(pure, main, -1)  # -1 is a mixed stand
+    n_dom_trees = int((analysis.stand.Area * 100) / 10000)
+    step = np.full(len(table), len(order) + 1)  # the k from which each tree is removed
+    step[order] = np.arange(1, len(order) + 1)
+
+    hdom = np.empty(len(order) + 1)
+    for g in np.unique(group).tolist():
+        eligible = alive & (table.species == SPECIES[g]) if g >= 0 else alive
+        rows = np.flatnonzero(eligible)
+        rows = rows[np.lexsort((rows, -table.est_height[rows]))]  # the first ones in the file win on ties, like keep_tallest()
+        heights = table.est_height[rows].tolist()
+        position = np.full(len(table), len(rows))
+        position[rows] = np.arange(len(rows))
+        steps, removed_positions = step[rows].tolist(), position[order].tolist()
+        total, count, next_tree = 0.0, 0, 0
+        for k in range(len(order) + 1):
+            if k > 0 and removed_positions[k - 1] < next_tree:  # a dominant tree was removed
+                total -= heights[removed_positions[k - 1]]
+                count -= 1
+            while count < n_dom_trees and next_tree < len(rows):
+                if steps[next_tree] > k:
+                    total += heights[next_tree]
+                    count += 1
+                next_tree += 1
+            if group[k] == g:
+                hdom[k] = total / count
+
+    N = counts.sum(axis=1) * f_exp
+    return 100/(hdom*np.sqrt(N))
+
+def thinning_order(analysis, method="below", species=None):
+    # Positions of the alive trees that can be removed (of some species), in the order in which they are removed
+    if method not in ("below", "above"):
+        raise ValueError(f"Unknown thinning method '{method}', please use 'below' or 'above'.")
+    table = analysis.trees
+    candidates = table.cod_status == 1
+    if species:
+        candidates &= np.isin(table.species, list(species))
+    rows = np.flatnonzero(candidates)
+    return rows[np.argsort(table.est_dbh[rows] if method == "below" else -table.est_dbh[rows], kind="stable")]
+
+def removal_mask(table, rows):
+    removed = np.zeros(len(table), dtype=bool)
+    removed[rows] = True
+    return removed
+
+def removed_wood(analysis, removed):
+    # What a thinning takes out of the stand, per hectare
+    table = analysis.trees
+    f_exp = 10000/analysis.stand.Area
+    return {
+        "Removed Trees (trees/ha)": int(np.count_nonzero(removed))*f_exp,
+        "Removed Basal Area (m²/ha)": float(table.basal_area[removed].sum())*f_exp,
+        "Removed Volume (m³/ha)": float(table.tree_volume[removed].sum())*f_exp,
+        "Removed Wood Value (€/ha)": float(table.wood_value[removed].sum())*f_exp,
+    }
+
+def thinned_stand(analysis, removed):
+    # Stand metrics of an analysed stand without some trees (a boolean mask), from the tree metrics that were already calculated
+    table = analysis.trees
+    stand = Stand()
+    stand.Area = analysis.stand.Area
+    alive = (table.cod_status == 1) & ~removed
+    counter = {code: int(np.count_nonzero(alive & (table.species == code))) for code in SPECIES}
+    stand.Main_species = pure_stand_species(counter)
+    f_exp = 10000/stand.Area
+    stand.Total = sum(counter.values())
+    stand.N = stand.Total*f_exp
+    stand.N_dead = int(np.count_nonzero((table.cod_status == 2) & ~removed))*f_exp
+
+    eligible = alive & (table.species == stand.Main_species) if stand.Main_species != "Mixed Stand" else alive
+    stand.n_dom_trees = min(int((stand.Area * 100) / 10000), int(np.count_nonzero(eligible)))
+    heights, dbhs, _ = keep_tallest(table.est_height[eligible], table.est_dbh[eligible], np.flatnonzero(eligible), stand.n_dom_trees)
+    stand.hdom = float(heights.sum()) / stand.n_dom_trees
+    stand.ddom = float(dbhs.sum()) / stand.n_dom_trees
+
+    stand.G_pov = float(table.basal_area[alive].sum())*f_exp
+    stand.V_pov = float(table.tree_volume[alive].sum())*f_exp
+    stand.Value_pov = float(table.wood_value[alive].sum())*f_exp
+    stand_density_metrics(stand)
+    set_stand_age(stand, analysis.age)
+    return stand
+
+UNCERTAINTY_METRICS = [  # (row of the uncertainty table, Stand attribute)
+    ("Tree Density (trees/ha)", "N"),
+    ("Dominant Height (m)", "hdom"),
+    ("Dominant Diametre (cm)", "ddom"),
+    ("Total Basal Area (m²/ha)", "G_pov"),
+    ("Total Volume (m³/ha)", "V_pov"),
+    ("Total Wood Value (€/ha)", "Value_pov"),
+    ("Mean Quadratic Diameter (cm)", "dg"),
+    ("Wilson Factor", "Fw"),
+    ("Site Index", "Site_index"),
+    ("Stand Density Index", "SDI"),
+]
+
+def stand_uncertainty(analysis, replicates=1000, coefficient_cv=0.05, area_cv=0.0, percentiles=(2.5, 50, 97.5), seed=None, workers=None, batch_size=None):
+    # Percentile bands of the stand metrics of an analysed stand (Monte Carlo). Each replicate resamples the trees
+    # of the plot with replacement (bootstrap), multiplies the volume and mercantile volume equations of every species
+    # by a random factor (mean 1, coefficient of variation coefficient_cv) and, with area_cv, the plot area.
+    # The volume equations are linear in their coefficient c and the wood value in the mercantile volume, so a replicate
+    # is the sum of the tree metrics already calculated weighted by how many times each tree was drawn: a batch of
+    # replicates is one matrix product, and the batches run in a thread pool (NumPy releases the GIL). The results
+    # only depend on the seed and batch_size, not on the number of workers
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor
+    table = analysis.trees
+    n_trees = len(table)
+    if batch_size is None:
+        batch_size = max(1, min(replicates, 2**22 // max(n_trees, 1)))  # about 32 MB of counts per batch
+    sizes = [min(batch_size, replicates - start) for start in range(0, replicates, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batches = list(executor.map(lambda job: uncertainty_replicates(analysis, *job, coefficient_cv, area_cv), zip(sizes, seeds)))
+    values = {attribute: np.concatenate([batch[attribute] for batch in batches]) for _, attribute in UNCERTAINTY_METRICS}
+
+    rows = []
+    for name, attribute in UNCERTAINTY_METRICS:
+        bands = np.nanpercentile(values[attribute], percentiles) if np.isfinite(values[attribute]).any() else np.full(len(percentiles), np.nan)
+        rows.append({"Metric": name, "Estimate": getattr(analysis.stand, attribute), **{f"P{percentile:g}": band for percentile, band in zip(percentiles, bands)}})
+    return pd.DataFrame(rows)
+
+def uncertainty_replicates(analysis, size, seed, coefficient_cv=0.05, area_cv=0.0):
+    # The stand metrics of a batch of Monte Carlo replicates, one array of length size per Stand attribute
+    table = analysis.trees
+    stand = analysis.stand
+    rng = np.random.default_rng(seed)
+    n_trees = len(table)
+    n_species = len(MODELS.species)
+    alive = table.cod_status == 1
+    index = MODELS.species_index(table.species)
+
+    # one column per species for the alive trees, the tree volumes and the wood values, then the basal area
+    columns = np.zeros((n_trees, 3 * n_species + 1))
+    rows = np.flatnonzero(alive & (index >= 0))
+    columns[rows, index[rows]] = 1
+    columns[rows, n_species + index[rows]] = table.tree_volume[rows]
+    columns[rows, 2 * n_species + index[rows]] = table.wood_value[rows]
+    columns[alive, -1] = table.basal_area[alive]
+
+    counts = rng.multinomial(n_trees, np.full(n_trees, 1 / n_trees), size=size).astype(float)
+    sums = counts @ columns
+
+    sigma = math.sqrt(math.log(1 + coefficient_cv ** 2))
+    volume_factor = rng.lognormal(-sigma ** 2 / 2, sigma, (size, n_species))
+    merc_factor = rng.lognormal(-sigma ** 2 / 2, sigma, (size, n_species))
+    sigma = math.sqrt(math.log(1 + area_cv ** 2))
+    area = stand.Area * rng.lognormal(-sigma ** 2 / 2, sigma, size)
+    f_exp = 10000 / area
+
+    # the dominant trees are the tallest draws of the main species of the stand, in the order of keep_tallest(),
+    # as many as the area of each replicate has (100 per hectare)
+    eligible = alive & (table.species == stand.Main_species) if stand.Main_species != "Mixed Stand" else alive
+    candidates = np.flatnonzero(eligible)
+    candidates = candidates[np.lexsort((candidates, -table.est_height[candidates]))]
+    drawn = counts[:, candidates]
+    before = np.cumsum(drawn, axis=1) - drawn
+    n_dom_trees = np.minimum((area * 100 / 10000).astype(int), drawn.sum(axis=1))
+    dominant = np.clip(n_dom_trees[:, None] - before, 0, drawn)
+
+    replicates = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        replicates["N"] = sums[:, :n_species].sum(axis=1) * f_exp
+        replicates["G_pov"] = sums[:, -1] * f_exp
+        replicates["V_pov"] = (sums[:, n_species:2 * n_species] * volume_factor).sum(axis=1) * f_exp
+        replicates["Value_pov"] = (sums[:, 2 * n_species:3 * n_species] * merc_factor).sum(axis=1) * f_exp
+        replicates["hdom"] = dominant @ table.est_height[candidates] / n_dom_trees
+        replicates["ddom"] = dominant @ table.est_dbh[candidates] / n_dom_trees
+        replicates["dg"] = np.sqrt((4 * replicates["G_pov"]) / (math.pi * replicates["N"])) * 100
+        replicates["Fw"] = 100 / (replicates["hdom"] * np.sqrt(replicates["N"]))
+        exponent = MODELS.sdi_exponent(stand.Main_species)
+        replicates["SDI"] = replicates["N"] * (replicates["dg"] / 25) ** exponent if exponent is not None else np.zeros(size)
+        if stand.Age and stand.Main_species != "Mixed Stand":
+            replicates["Site_index"] = site_index(stand.Main_species, replicates["hdom"], stand.Age)
+        else:
+            replicates["Site_index"] = np.zeros(size)
+    return replicates
+
+class StageProfiler:
+    # Optional measurements of the stages of a run: wall time, rows, rows per second and peak memory (RSS).
+    # Each finished stage is passed to the callback (to send it to a metrics system) and, with a path,
+    # the JSON report of all the stages is written again, so it is there even if the program is closed
+
+    def __init__(self, callback=None, path=None):
+        self.callback = callback
+        self.path = path
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        record = {"stage": name, "rows": rows}
+        start = time.perf_counter()
+        yield record  # a stage that only knows its rows at the end sets record["rows"]
+        record["seconds"] = round(time.perf_counter() - start, 6)
+        record["rows_per_second"] = round(record["rows"] / record["seconds"]) if record["rows"] and record["seconds"] > 0 else None
+        record["peak_rss_mb"] = peak_rss_mb()
+        self.stages.append(record)
+        if self.callback:
+            self.callback(record)
+        if self.path:
+            with open(self.path, "w") as file:
+                json.dump(self.report(), file, indent=2)
+
+    def report(self):
+        return {"stages": self.stages, "total_seconds": round(sum(record["seconds"] for record in self.stages), 6)}
+
+def profile_stage(profiler, name, rows=None):
+    # Measures a stage when there is a profiler, otherwise it does nothing
+    if profiler is None:
+        return contextlib.nullcontext({})
+    return profiler.stage(name, rows)
+
+def peak_rss_mb():
+    # Most memory the process has used so far, None where the resource module does not exist (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)  # bytes on macOS, kilobytes on Linux
+
+class ResultCache:
+    # Stand analyses saved on disk, one .npz file per analysis with the tree table and the Stand results.
+    # The key is a hash of the contents of the file plus the area, the age, MODEL_VERSION and the species models,
+    # so a changed file or coefficient never gets old results. The least recently used analyses are deleted when there are more than
+    # max_entries or they take more than max_bytes
+
+    def __init__(self, directory=".stand_cache", max_entries=256, max_bytes=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, file_path, area=1000, age=None, allow_extra_columns=False):
+        digest = hashlib.sha256()
+        try:
+            with open(file_path, "rb") as file:
+                for block in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(block)
+        except FileNotFoundError:
+            raise FileNotFoundError("There was an error reading the file, please correct and restart.")
+        digest.update(repr((float(area), age, bool(allow_extra_columns), MODEL_VERSION, MODELS.fingerprint)).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        # Returns the cached InventoryAnalysis, or None if it is not in the cache
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                trees = TreeTable({name: data[name] for name in TREE_COLUMNS})
+                stand_values = json.loads(data["stand"].item())
+                age = json.loads(data["age"].item())
+            os.utime(path)  # the modification time says when it was last used
+        except (OSError, ValueError, KeyError):
+            return None  # not cached, or a file that was being written or deleted by another process
+        analysis = InventoryAnalysis(trees, stand_values["Area"])
+        vars(analysis.stand).update(stand_values)
+        analysis.age = age
+        return analysis
+
+    def put(self, key, analysis):
+        temporary = self.path(key) + f".{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            np.savez(file, stand=np.array(json.dumps(vars(analysis.stand), default=float)), age=np.array(json.dumps(analysis.age)), **analysis.trees.columns())
+        os.replace(temporary, self.path(key))  # other processes never see half written files
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, "*.npz")):
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                pass
+        entries.sort(reverse=True)  # most recently used first
+        total_bytes = 0
+        for n, (_, size, path) in enumerate(entries):
+            total_bytes += size
+            if (self.max_entries is not None and n >= self.max_entries) or (self.max_bytes is not None and total_bytes > self.max_bytes):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.directory, "*.npz")):
+            os.remove(path)
+
+def batch_jobs(source, area=1000, age=None):
+    # A batch is either a folder with plot files or a manifest (csv file with the columns 'file', 'area' and 'age',
+    # and optionally 'stratum' for stratified_estimates())
+    import pandas as pd
+    if os.path.isdir(source):
+        files = sorted(glob.glob(os.path.join(source, "*.csv")))
+        return [{"file": file, "area": area, "age": age} for file in files]
+
+    manifest = pd.read_csv(source)
+    if "file" not in manifest.columns:
+        raise ValueError("The manifest needs a 'file' column, please correct and restart.")
+    folder = os.path.dirname(source)
+    jobs = []
+    for row in manifest.to_dict("records"):
+        plot_area = row.get("area", area)
+        plot_age = row.get("age", age)
+        job = {
+            "file": os.path.join(folder, row["file"]),
+            "area": area if pd.isna(plot_area) else float(plot_area),
+            "age": None if pd.isna(plot_age) else int(plot_age),
+        }
+        if "stratum" in row:
+            job["stratum"] = row["stratum"]
+        jobs.append(job)
+    return jobs
+
+def analyse_plot(job):
+    # Runs the whole analysis of one plot file, this is what each worker process of run_batch() does
+    plot = os.path.splitext(os.path.basename(job["file"]))[0]
+    if job.get("models") and job["models"] != MODELS.path:
+        load_species_models(job["models"])  # worker processes that do not share the models of the main program
+    if job.get("prices") and job["prices"] != MODELS.prices():
+        MODELS.set_prices(job["prices"])  # the prices changed with set_prices() are not in the file
+    try:
+        cache = ResultCache(job["cache"]) if job.get("cache") else None
+        analysis = analyse_stand(job["file"], job["area"], job["age"], job.get("allow_extra_columns", False), cache)
+        if job.get("out_dir"):
+            file_format = job.get("format", "csv")
+            write_table(analysis.tree_metrics_table(rounded=file_format == "csv"), os.path.join(job["out_dir"], f"{plot}_metrics_tree"), file_format)
+        if job.get("charts"):
+            render_stand_charts({
+                "name": plot,
+                "dbh": class_distribution(analysis.trees, "dbh")["Trees"],
+                "height": class_distribution(analysis.trees, "height")["Trees"],
+                "out_dir": job["out_dir"],
+            })
+        stand_row = analysis.stand_metrics_table().iloc[0].to_dict()
+        error = ""
+    except (ValueError, FileNotFoundError, ZeroDivisionError) as e:
+        stand_row = {}
+        error = str(e)
+    strata = {"Stratum": job["stratum"]} if "stratum" in job else {}
+    return {"Plot": plot, **strata, **stand_row, "Error": error}
+
+ESTIMATE_METRICS = ["Tree Density (trees/ha)", "Total Basal Area (m²/ha)", "Total Volume (m³/ha)", "Total Wood Value (€/ha)"]
+
+def stratified_estimates(plots, strata_areas, metrics=None, by="Stratum", z=1.96):
+    # Stand and estate estimates from many plots (stratified random sampling). plots has one row per plot with its
+    # stratum and the per hectare stand metrics (the metrics_stands table of run_batch()), strata_areas the area of
+    # each stratum in hectares. Every stratum is calculated at once with grouped sums (np.bincount) of each metric.
+    # Returns two tables: one row per stratum and metric (plots, mean, variance, standard error, sampling error in %
+    # of the mean at the confidence of z, area, total and its standard error) and one row per metric for the estate.
+    # A stratum with a single plot has no variance (NaN): it is left out of the estate standard error, which is then
+    # too small, and counted in "Strata Without Variance" so the estimate can be read with care
+    import pandas as pd
+    metrics = list(metrics or ESTIMATE_METRICS)
+    if "Error" in plots:
+        plots = plots[plots["Error"].fillna("") == ""]  # the plots that could not be analysed
+    if by not in plots:
+        raise ValueError(f"The plots need a '{by}' column (a 'stratum' column in the manifest), please correct and restart.")
+    codes, strata = pd.factorize(plots[by], sort=True)
+    missing = [str(stratum) for stratum in strata if stratum not in strata_areas]
+    if missing:
+        raise ValueError(f"There is no area for the strata {', '.join(missing)}, please correct and restart.")
+
+    values = plots[metrics].to_numpy(dtype=float)
+    n = np.bincount(codes, minlength=len(strata)).astype(float)
+    mean = np.column_stack([np.bincount(codes, values[:, j], len(strata)) for j in range(len(metrics))]) / n[:, None]
+    squares = np.column_stack([np.bincount(codes, (values[:, j] - mean[codes, j]) ** 2, len(strata)) for j in range(len(metrics))])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = np.where(n[:, None] > 1, squares / (n[:, None] - 1), np.nan)  # a stratum with one plot has no variance
+        se = np.sqrt(variance / n[:, None])
+        area = np.array([strata_areas[stratum] for stratum in strata], dtype=float)
+        weights = area / area.sum()
+
+        strata_df = pd.DataFrame({
+            by: np.repeat(strata, len(metrics)),
+            "Metric": np.tile(metrics, len(strata)),
+            "Plots": np.repeat(n, len(metrics)).astype(int),
+            "Mean (/ha)": mean.ravel(),
+            "Variance": variance.ravel(),
+            "Standard Error": se.ravel(),
+            "Sampling Error (%)": (z * se / mean * 100).ravel(),
+            "Area (ha)": np.repeat(area, len(metrics)),
+            "Total": (mean * area[:, None]).ravel(),
+            "Total Standard Error": (se * area[:, None]).ravel(),
+        })
+
+        estate_mean = weights @ mean
+        estate_se = np.sqrt((weights ** 2) @ np.nan_to_num(se ** 2))  # the strata with one plot have no variance to add
+        estate_df = pd.DataFrame({
+            "Metric": metrics,
+            "Plots": int(n.sum()),
+            "Strata": len(strata),
+            "Strata Without Variance": int(np.count_nonzero(n < 2)),
+            "Mean (/ha)": estate_mean,
+            "Standard Error": estate_se,
+            "Sampling Error (%)": z * estate_se / estate_mean * 100,
+            "Area (ha)": area.sum(),
+            "Total": estate_mean * area.sum(),
+            "Total Standard Error": estate_se * area.sum(),
+        })
+    return strata_df, estate_df
+
+def read_strata_areas(path):
+    # csv file with the columns 'stratum' and 'area' (hectares)
+    import pandas as pd
+    strata = pd.read_csv(path)
+    if not {"stratum", "area"} <= set(strata.columns):
+        raise ValueError("The strata file needs the columns 'stratum' and 'area', please correct and restart.")
+    return dict(zip(strata["stratum"], strata["area"]))
+
+def run_batch(source, out_dir="batch_output", area=1000, age=None, allow_extra_columns=False, workers=None, charts=False, file_format="csv", cache_dir=None):
+    # Analyses many plot files in parallel (one process per core by default) and writes
+    # one table with the stand metrics of all the plots plus the tree metrics table (and the histograms) of each plot
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = batch_jobs(source, area, age)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    for job in jobs:
+        job["out_dir"] = out_dir
+        job["allow_extra_columns"] = allow_extra_columns
+        job["charts"] = charts and bool(out_dir)
+        job["format"] = file_format
+        job["cache"] = cache_dir
+        job["models"] = MODELS.path
+        job["prices"] = MODELS.prices()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 4))
+        rows = list(executor.map(analyse_plot, jobs, chunksize=chunksize))
+
+    stands_df = pd.DataFrame(rows, columns=None if rows else ["Plot", "Error"])  # a batch without plots still has the columns
+    for column in ["Stand Age (yr)", "Number of Trees", "Number of Dominant Trees"]:
+        if column in stands_df:
+            stands_df[column] = stands_df[column].astype("Int64")  # keeps them integers next to failed plots
+    if out_dir:
+        write_table(stands_df, os.path.join(out_dir, "metrics_stands"), file_format)
+    return stands_df
+
+def analyse_tree_batch(jobs):
+    # Analyses many small stands together, like the requests that reach the AnalysisService at the same time.
+    # jobs is a list of (DataFrame, area, age). Each stand is validated and gets its dominant trees on its own, then the
+    # tree metrics of all the stands are calculated in one call, each tree with the hdom of its stand.
+    # Returns one InventoryAnalysis per job, or the error that stopped it
+    results = []
+    for df, area, age in jobs:
+        try:
+            validate_columns(df, False)
+            trees = tree_table_from_dataframe(df)
+            if not trees:
+                raise ValueError("The given file is empty, please correct and restart.")
+            analysis = InventoryAnalysis(trees, area)
+            analysis.calculate_missing_dbh_h()
+            stand_structure(analysis.trees, analysis.stand)
+            analysis.age = age
+            results.append(analysis)
+        except (ValueError, ZeroDivisionError) as e:
+            results.append(e)
+
+    analyses = [result for result in results if isinstance(result, InventoryAnalysis)]
+    if analyses:
+        columns = {name: np.concatenate([getattr(analysis.trees, name) for analysis in analyses]) for name in ["species", "cod_status", "est_dbh", "est_height"]}
+        hdom = np.concatenate([np.full(len(analysis.trees), analysis.stand.hdom) for analysis in analyses])
+        metrics = tree_metrics_arrays(columns["species"], columns["cod_status"], columns["est_dbh"], columns["est_height"], hdom)
+        bounds = np.cumsum([0] + [len(analysis.trees) for analysis in analyses])
+        for analysis, start, end in zip(analyses, bounds[:-1], bounds[1:]):
+            for name, values in metrics.items():
+                setattr(analysis.trees, name, values[start:end].copy())
+            try:
+                stand_totals(analysis.age, analysis.trees, analysis.stand)
+            except (ValueError, ZeroDivisionError) as e:
+                results[results.index(analysis)] = e  # only this stand fails, not the others of the batch
+    return results
+
+def service_request(content_type, body, query):
+    # The trees, area, age and include_trees of a request to the AnalysisService: a JSON object or a csv body
+    import io
+    import pandas as pd
+    if content_type.startswith("text/csv"):
+        options = {name: values[-1] for name, values in query.items()}
+        df = pd.read_csv(io.BytesIO(body))
+    else:
+        try:
+            options = json.loads(body or b"{}")
+        except ValueError:
+            raise ValueError("The request is not valid JSON, please correct and restart.")
+        if not isinstance(options, dict):
+            raise ValueError("The request must be a JSON object, please correct and restart.")
+        if "csv" not in options and "trees" not in options:
+            raise ValueError("The request needs the trees ('trees' or 'csv'), please correct and restart.")
+        if not isinstance(options.get("csv", ""), str) or not isinstance(options.get("trees", []), list):
+            raise ValueError("'trees' must be a list of trees and 'csv' the text of a csv file, please correct and restart.")
+        df = pd.read_csv(io.StringIO(options["csv"])) if "csv" in options else pd.DataFrame(options["trees"])
+    try:
+        area = float(options.get("area", 1000))
+        age = options.get("age")
+        age = None if age in (None, "") else int(age)
+    except (TypeError, ValueError):
+        raise ValueError("The area and the age must be numbers, please correct and restart.")
+    if not area > 0:
+        raise ValueError("The stand area must be a positive value, please correct and restart.")
+    include_trees = str(options.get("include_trees", False)).lower() in ("1", "true")
+    return df, area, age, include_trees
+
+class AnalysisService:
+    # Local HTTP service (TCP or Unix socket) for the field app. The species models and pandas stay loaded, and the
+    # plots that arrive within batch_window seconds of each other are analysed together by analyse_tree_batch()
+    # in a thread pool, so a burst of uploads is one vectorized evaluation instead of one per plot.
+    #     POST /analyse  JSON {"trees": [{"tree_ID": 1, "species": "Pb", "DBH": 20, "height": 15, "COD_Status": 1}, ...]
+    #                    (or "csv": "<csv text>"), "area": 1000, "age": 30, "include_trees": false}
+    #                    or a csv body (Content-Type: text/csv) with the options in the query: /analyse?area=1000&age=30
+    #     GET /health
+    # The answer is the stand metrics (and the tree metrics) as JSON, or {"error": ...} with status 400
+
+    def __init__(self, batch_window=0.005, max_batch=64, workers=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.batches = 0  # batches analysed, with self.requests it shows how much the requests are grouped
+        self.requests = 0
+        self._queue = None
+        self._tasks = set()
+
+    async def start(self, host="127.0.0.1", port=8080, path=None):
+        import asyncio
+        import pandas as pd
+        # the first request should not pay for the imports and the first calculations
+        analyse_tree_batch([(pd.DataFrame({"tree_ID": [1], "species": [SPECIES[0]], "DBH": [20.0], "height": [15.0], "COD_Status": [1]}), 1000, None)])
+        self._queue = asyncio.Queue()
+        self._keep(asyncio.create_task(self._batch_loop()))
+        if path:
+            return await asyncio.start_unix_server(self._handle, path)
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def analyse(self, df, area=1000, age=None):
+        import asyncio
+        future = asyncio.get_running_loop().create_future()
+        self.requests += 1
+        await self._queue.put(((df, area, age), future))
+        return await future
+
+    def _keep(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _batch_loop(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+            self.batches += 1
+            self._keep(loop.create_task(self._run_batch(batch)))
+
+    async def _run_batch(self, batch):
+        import asyncio
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, analyse_tree_batch, [job for job, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _handle(self, reader, writer):
+        import asyncio
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line.strip() == b"":
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    status, payload = "400 Bad Request", {"error": "The request is not valid HTTP."}
+                    keep_alive = False  # the rest of the stream cannot be trusted
+                else:
+                    body = await reader.readexactly(length)
+                    try:
+                        status, payload = await self._respond(method, target, headers, body)
+                    except Exception as e:  # the client always gets an answer, even for an unexpected error
+                        status, payload = "500 Internal Server Error", {"error": f"The request could not be answered ({type(e).__name__}: {e})."}
+                data = json.dumps(payload).encode()
+                writer.write((f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client closed the connection
+        finally:
+            writer.close()
+
+    async def _respond(self, method, target, headers, body):
+        from urllib.parse import urlsplit, parse_qs
+        url = urlsplit(target)
+        if url.path == "/health" and method == "GET":
+            return "200 OK", {"status": "ok", "species": SPECIES, "requests": self.requests, "batches": self.batches}
+        if url.path != "/analyse":
+            return "404 Not Found", {"error": f"Unknown path {url.path}, use POST /analyse or GET /health."}
+        if method != "POST":
+            return "405 Method Not Allowed", {"error": "Use POST to send the trees to /analyse."}
+        try:
+            df, area, age, include_trees = service_request(headers.get("content-type", ""), body, parse_qs(url.query))
+            analysis = await self.analyse(df, area, age)
+        except (ValueError, ZeroDivisionError) as e:
+            return "400 Bad Request", {"error": str(e)}
+        payload = {"stand": json.loads(analysis.stand_metrics_table().to_json(orient="records"))[0]}
+        if include_trees:
+            payload["trees"] = json.loads(analysis.tree_metrics_table(rounded=False).to_json(orient="records"))
+        return "200 OK", payload
+
+def serve(host="127.0.0.1", port=8080, path=None, batch_window=0.005, max_batch=64, workers=None):
+    # Runs the AnalysisService until the program is closed (Ctrl+C)
+    import asyncio
+
+    async def run():
+        server = await AnalysisService(batch_window, max_batch, workers).start(host, port, path)
+        print(f"Forest Inventory Assistant service on {path or f'http://{host}:{port}'} (Ctrl+C to stop)")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+def main(profiler=None):
     Tree.clear_tree_list()
     file_path = welcome_message()
-    read_data(file_path)
+    with profile_stage(profiler, "read_data") as stage:
+        read_data(file_path)
+        stage["rows"] = len(Tree.tree_list)
     input_stand_area()
-    calculate_missing_dbh_h()
-    stand_metrics()
+    with profile_stage(profiler, "calculate_missing_dbh_h", len(Tree.tree_list)):
+        calculate_missing_dbh_h()
+    with profile_stage(profiler, "stand_metrics", len(Tree.tree_list)):
+        stand_metrics()
+    site_index_calculation()
 
-    # Variables to store histogram figures
-    fig_dbh, fig_height = create_histogram(Tree.tree_list)  # Create histograms after data is loaded
 
     while True:
         option = main_menu()
@@ -700,15 +2239,98 @@ def main():
         elif option == '2':
             print_tree_stats()  # Display the tree metrics table
         elif option == '3':
-            # Display the histograms
+            # Display the histograms, they are only drawn when they are needed
+                import matplotlib.pyplot as plt
+                with profile_stage(profiler, "create_histogram", len(Tree.tree_list)):
+                    create_histogram(Tree.tree_list)
                 plt.show()
         elif option == '4':
-            export_to_csv()  # Export metrics to CSV
+            with profile_stage(profiler, "export_to_csv", len(Tree.tree_list)):
+                export_to_csv()  # Export metrics to CSV
         elif option == '5':
             # Export histograms to PNG
-                export_plots_to_png(fig_dbh, fig_height)
+                with profile_stage(profiler, "create_histogram", len(Tree.tree_list)):
+                    figures = create_histogram(Tree.tree_list, headless=True)
+                export_plots_to_png(*figures)
         elif option == '6':
             sys.exit("\nExiting program...\n")
 
+def cli(argv):
+    # Non-interactive program: everything comes from the command line, nothing is asked to the user
+    parser = argparse.ArgumentParser(description="Forest Inventory Assistant - run without questions (no arguments starts the interactive program)")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--csv", help="csv file with the tree data of one stand")
+    source.add_argument("--batch", help="folder with plot csv files, or a manifest csv with the columns 'file', 'area' and 'age'")
+    source.add_argument("--serve", type=int, metavar="PORT", help="run the analysis service (POST /analyse) on a local port")
+    source.add_argument("--socket", metavar="PATH", help="run the analysis service on a Unix socket")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the service for --serve (default 127.0.0.1)")
+    parser.add_argument("--area", type=float, default=1000, help="stand area in square meters (default 1000)")
+    parser.add_argument("--age", type=int, help="stand age, used for the site index of pure stands")
+    parser.add_argument("--allow-extra-columns", action="store_true", help="ignore extra columns instead of rejecting the file")
+    parser.add_argument("--out-dir", help="folder for the output files (default: the current folder, batch_output for --batch)")
+    parser.add_argument("--no-plots", action="store_true", help="do not export the histograms as png files")
+    parser.add_argument("--format", choices=list(TABLE_FORMATS), default="csv", help="format of the output tables (parquet and feather need pyarrow)")
+    parser.add_argument("--workers", type=int, help="number of processes for --batch, or threads for --uncertainty and the service (default: one per core)")
+    parser.add_argument("--profile", metavar="FILE", help="write the time, rows per second and peak memory of each stage to a JSON file")
+    parser.add_argument("--species-models", metavar="FILE", help="JSON or TOML file with the equations of the species (default species_models.json)")
+    parser.add_argument("--cache", help="folder where the results are cached, files that did not change are not analysed again")
+    parser.add_argument("--strata", metavar="FILE", help="csv file with the columns 'stratum' and 'area' (ha), --batch also writes the stratum and estate estimates (the manifest needs a 'stratum' column)")
+    parser.add_argument("--uncertainty", type=int, metavar="N", help="write the 2.5, 50 and 97.5 percentiles of the stand metrics from N Monte Carlo replicates (--csv only)")
+    args = parser.parse_args(argv)
+
+    if args.area <= 0:
+        parser.error("the stand area must be a positive value")
+
+    if args.species_models:
+        try:
+            load_species_models(os.path.abspath(args.species_models))
+        except (ValueError, FileNotFoundError) as e:
+            sys.exit(str(e))
+    if args.serve is not None or args.socket:
+        serve(args.host, args.serve, args.socket, workers=args.workers)
+        return
+    profiler = StageProfiler(path=args.profile) if args.profile else None
+    if args.batch:
+        out_dir = args.out_dir or "batch_output"
+        with profile_stage(profiler, "run_batch") as stage:
+            stands_df = run_batch(args.batch, out_dir, args.area, args.age, args.allow_extra_columns, args.workers, charts=not args.no_plots, file_format=args.format, cache_dir=args.cache)
+            stage["rows"] = len(stands_df)  # plots
+        if stands_df.empty:
+            print(f"No plot files found in {args.batch}.")
+            return
+        if args.strata:
+            try:
+                strata_df, estate_df = stratified_estimates(stands_df, read_strata_areas(args.strata))
+            except (ValueError, FileNotFoundError) as e:
+                sys.exit(str(e))
+            write_table(strata_df, os.path.join(out_dir, "metrics_strata"), args.format)
+            write_table(estate_df, os.path.join(out_dir, "metrics_estate"), args.format)
+        failed = stands_df["Error"] != ""
+        print(f"{len(stands_df)} plots analysed, {failed.sum()} with errors. Results in {out_dir}")
+        return
+
+    out_dir = args.out_dir or "."
+    try:
+        analysis = analyse_stand(args.csv, args.area, args.age, args.allow_extra_columns, ResultCache(args.cache) if args.cache else None, profiler)
+    except (ValueError, FileNotFoundError) as e:
+        sys.exit(str(e))
+    os.makedirs(out_dir, exist_ok=True)
+    print_stand_stats(analysis.stand)
+    with profile_stage(profiler, "export_to_csv" if args.format == "csv" else "export_tables", len(analysis.trees)):
+        if args.format == "csv":
+            analysis.export_to_csv(os.path.join(out_dir, "metrics_tree.csv"), os.path.join(out_dir, "metrics_stand.csv"))
+        else:
+            analysis.export_tables(out_dir, args.format)
+    if args.uncertainty:
+        with profile_stage(profiler, "uncertainty", len(analysis.trees)):
+            write_table(analysis.uncertainty(args.uncertainty, workers=args.workers), os.path.join(out_dir, "metrics_uncertainty"), args.format)
+    if not args.no_plots:
+        with profile_stage(profiler, "create_histogram", len(analysis.trees)):
+            fig_dbh, fig_height = create_histogram(analysis.trees, headless=True)
+            export_plots_to_png(fig_dbh, fig_height, out_dir)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        cli(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file
@@ -2,6 +2,10 @@ import pytest
 from unittest.mock import patch
 from project import *
 import re
+import json
+import os
+import numpy as np
+import pandas as pd
 
 def test_empty_csv():
     file_path = r"more_tree_data\tree_data_empty.csv"
@@ -140,6 +144,20 @@ def test_short_dbh_Ec():
     with pytest.raises(ValueError, match="There is a Eucalyptus' DBH value that's less than 5cm, this is not considered a tree, please correct and restart."):
         read_data(file_path)
 
+def test_short_dbh_alias():
+    # the minimum DBH comes from species_models.json, an alias has the one of its species
+    assert (MODELS.min_dbh("Pb"), MODELS.min_dbh("Ec"), MODELS.min_dbh("Eu")) == (7.5, 5, 5)
+    df = pd.DataFrame({"tree_ID": [1, 2], "species": ["Pb", "Eu"], "DBH": [20.0, 6.0], "height": [15.0, 8.0], "COD_Status": 1})
+    assert analyse_trees(df).trees.species.tolist() == ["Pb", "Ec"]
+    with pytest.raises(ValueError, match="There is a DBH value that's less than 7.5cm"):
+        analyse_trees(df.assign(species=["Pb", "Pb"]))
+    with pytest.raises(ValueError, match="There is a Eucalyptus' DBH value that's less than 5cm"):
+        analyse_trees(df.assign(DBH=[20.0, 4.0]))
+    tree = Tree.__new__(Tree)
+    tree.set_dbh(6, "Eu")
+    with pytest.raises(ValueError, match="There is a Eucalyptus' DBH value that's less than 5cm"):
+        tree.set_dbh(4, "Eu")
+
 def test_wrong_cod_status():
     file_path = r"more_tree_data\tree_data_wrongcodstatus.csv"
     with pytest.raises(ValueError, match="There is an invalid COD_status value, please correct and restart"):
@@ -225,4 +243,594 @@ def test_values():
     assert round(Stand.dg, 2) == 12
     assert round(Stand.Fw, 2) == 0.92
     assert Stand.Site_index == 0 
-    assert round(Stand.SDI, 4) == 14.9096
\ No newline at end of file
+    assert round(Stand.SDI, 4) == 14.9096
+
+def test_values_Pm_Sb():
+    file_path = r"more_tree_data/tree_data__perfect_short_Pm_Sb.csv"
+    read_data(file_path)
+    with patch('builtins.input', return_value=""):
+        input_stand_area()
+    calculate_missing_dbh_h()
+    with patch('builtins.input', return_value=""):
+        stand_metrics()
+
+    volumes = {tree.tree_ID: round(tree.tree_volume, 4) for tree in Tree.tree_list}
+    assert volumes == {1: 0.3861, 2: 0.2548, 3: 0.8227, 4: 0.6274}
+    for tree in Tree.tree_list:
+        if tree.cod_status == 1:
+            assert tree.aerial_biom == tree.trunk_biom + tree.bark_biom + tree.branch_biom + tree.leaves_biom
+        else:
+            assert tree.total_biom == 0
+    assert round(Stand.V_pov, 4) == 14.6361
+
+def test_several_duplicate_ids():
+    file_path = r"more_tree_data/tree_data_idduplicates.csv"
+    with pytest.raises(ValueError, match="Tree IDs 2, 4 are duplicate in the table, please correct and restart."):
+        read_data(file_path)
+
+def test_validation_report():
+    file_path = r"more_tree_data/tree_data_severalerrors.csv"
+    with pytest.raises(ValueError, match="There are 3 problems in the file") as error:
+        read_data(file_path)
+    report = str(error.value).splitlines()
+    assert report[1] == "Line 3: There is a species value that is not acceptable (not 'Pb', 'Pm', 'Ec', or 'Sb'), please correct and restart"
+    assert report[2] == "Line 4: There is a negative DBH value, please correct and restart."
+    assert report[3] == "Line 5: There is an invalid COD_status value, please correct and restart"
+
+def test_stream_stand_metrics():
+    file_path = r"more_tree_data/tree_data__perfect_verylong.csv"
+    read_data(file_path)
+    with patch('builtins.input', return_value=""):
+        input_stand_area()
+    calculate_missing_dbh_h()
+    with patch('builtins.input', return_value=""):
+        stand_metrics()
+    stand = stream_stand_metrics(file_path, area=1000, chunksize=7)
+    assert stand.Main_species == Stand.Main_species
+    assert stand.Total == Stand.Total
+    assert stand.n_dom_trees == Stand.n_dom_trees
+    assert stand.ddom == pytest.approx(Stand.ddom)
+    for attribute in ["N", "N_dead", "hdom", "G_pov", "V_pov", "Value_pov", "dg", "Fw", "SDI"]:
+        assert getattr(stand, attribute) == pytest.approx(getattr(Stand, attribute))
+
+def test_stream_errors_across_chunks():
+    with pytest.raises(ValueError, match="Tree ID 4 is duplicate in the table, please correct and restart."):
+        stream_stand_metrics(r"more_tree_data/tree_data_idduplicate.csv", chunksize=2)
+    with pytest.raises(ValueError, match="Line 5: There is a missing tree_id value, please correct and restart"):
+        stream_stand_metrics(r"more_tree_data/tree_data_missingtreeid.csv", chunksize=2)
+
+def test_tree_table():
+    file_path = r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv"
+    read_data(file_path)
+    table = Tree.tree_list
+    assert isinstance(table, TreeTable)
+    assert len(table) == 6
+    assert table.est_dbh.dtype == np.float64
+    assert table.cod_status.dtype == np.int8
+    assert table[3].species == "Ec" and table[3].height == 90
+    assert table.row_of(4) == 3 and not table.has_tree_ID(7)
+    pines = table.take(table.species == "Pb")
+    assert pines.tree_ID.tolist() == [1, 2, 3, 5, 6]
+    table.append(Tree(7, "Pb", 20.0, 15.0, 1))
+    assert len(Tree.tree_list) == 7 and table.has_tree_ID(7)
+    Tree.clear_tree_list()
+    assert not Tree.tree_list
+
+def test_tree_table_append():
+    # one tree at a time keeps the index of the tree IDs and does not copy the table for every tree
+    Tree.clear_tree_list()
+    table = Tree.tree_list
+    for tree_ID in range(1, 101):
+        assert not Tree.is_duplicate_tree_ID(tree_ID)
+        Tree.add_tree(Tree(tree_ID, "Pb", 20.0 + tree_ID, 15.0, 1))
+    assert table._index is not None and table.row_of(100) == 99
+    assert len(table) == 100 and table.dbh[-1] == 120 and table.tree_ID.dtype == np.int64
+    assert len(table._buffers["dbh"]) < 400  # grows by doubling
+    with pytest.raises(ValueError, match="Tree ID 50 is duplicate in the table"):
+        Tree(50, "Pb", 20.0, 15.0, 1)
+
+    before = table.species
+    Tree.add_tree(Tree(101, "Pnig", 20.0, 15.0, 1))  # a longer species code widens the column
+    assert table.species[-1] == "Pnig" and before.tolist() == ["Pb"] * 100
+    table.extend(TreeTable({"tree_ID": [102], "species": ["Ec"], "dbh": [10.0], "height": [8.0], "cod_status": [1]}))
+    assert table.row_of(102) == 101 and table.row_of(101) == 100
+    Tree.clear_tree_list()
+    assert not Tree.tree_list
+
+def test_run_batch(tmp_path):
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(
+        "file,area,age\n"
+        f"{os.path.abspath('more_tree_data/tree_data__perfect_short_Pb_Ec.csv')},1000,\n"
+        f"{os.path.abspath('more_tree_data/tree_data__perfect_long.csv')},500,30\n"
+        f"{os.path.abspath('more_tree_data/tree_data_negdbh.csv')},1000,\n"
+    )
+    stands_df = run_batch(str(manifest), out_dir=str(tmp_path / "out"), workers=2)
+    assert stands_df["Plot"].tolist() == ["tree_data__perfect_short_Pb_Ec", "tree_data__perfect_long", "tree_data_negdbh"]
+    first, second, failed = stands_df.to_dict("records")
+    assert first["Error"] == "" and first["Tree Density (trees/ha)"] == 60
+    assert round(first["Total Wood Value (€/ha)"], 4) == 190.6585
+    assert second["Area (ha)"] == 0.05 and second["Stand Age (yr)"] == 30 and second["Site Index"] > 0
+    assert "There is a negative DBH value" in failed["Error"]
+    assert (tmp_path / "out" / "metrics_stands.csv").exists()
+    assert (tmp_path / "out" / "tree_data__perfect_long_metrics_tree.csv").exists()
+    assert not (tmp_path / "out" / "tree_data_negdbh_metrics_tree.csv").exists()
+
+    # the prices changed at runtime reach the workers, also the ones that load the models from the file again
+    try:
+        models = load_species_models()
+        models.set_prices({"Pb": {"Sawlogs 15-35 cm": 60}, "Ec": {"Pulpwood 6+ cm": 45}})
+        expected = analyse_stand(r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv").stand.Value_pov
+        assert expected != first["Total Wood Value (€/ha)"]
+        repriced = run_batch(str(manifest), out_dir=None, workers=2).iloc[0]
+        assert repriced["Total Wood Value (€/ha)"] == pytest.approx(expected)
+        job = batch_jobs(str(manifest))[0]
+        job["prices"] = models.prices()
+        load_species_models()  # like a worker that reads the file again
+        assert analyse_plot(job)["Total Wood Value (€/ha)"] == pytest.approx(expected)
+    finally:
+        load_species_models()
+
+    # a folder without plot files
+    (tmp_path / "empty").mkdir()
+    assert run_batch(str(tmp_path / "empty"), out_dir=str(tmp_path / "out_empty")).empty
+    with patch("builtins.print") as mock_print:
+        cli(["--batch", str(tmp_path / "empty"), "--out-dir", str(tmp_path / "out_empty")])
+    mock_print.assert_called_once_with(f"No plot files found in {tmp_path / 'empty'}.")
+
+def test_inventory_analysis_concurrent():
+    from concurrent.futures import ThreadPoolExecutor
+    files = [r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv", r"more_tree_data/tree_data__perfect_verylong.csv", r"tree_data.csv"] * 4
+    Tree.clear_tree_list()
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        analyses = list(executor.map(lambda file_path: InventoryAnalysis.from_csv(file_path, area=1000, age=20), files))
+    assert not Tree.tree_list  # the analyses do not use the class-level trees
+
+    first = analyses[0].stand
+    assert first.Main_species == "Pb" and first.N == 60 and first.hdom == 14
+    assert round(first.Value_pov, 4) == 190.6585
+    assert analyses[2].stand.Main_species == "Ec" and round(analyses[2].stand.V_pov, 4) == 326.9404
+    for analysis, again in zip(analyses[:3], analyses[3:6]):
+        assert analysis.stand_metrics_table().equals(again.stand_metrics_table())
+        assert analysis.tree_metrics_table().equals(again.tree_metrics_table())
+
+def test_keep_tallest():
+    rng = np.random.default_rng(1)
+    heights = rng.integers(10, 20, 500).astype(float)  # many ties
+    dbhs = rng.uniform(10, 40, 500)
+    orders = np.arange(500)
+    expected = sorted(orders, key=lambda i: heights[i], reverse=True)[:37]
+    top_heights, top_dbhs, top_orders = keep_tallest(heights, dbhs, orders, 37)
+    assert top_orders.tolist() == expected
+    assert top_dbhs.tolist() == dbhs[expected].tolist()
+
+    # merging the candidates of two chunks gives the same trees
+    first = keep_tallest(heights[:250], dbhs[:250], orders[:250], 37)
+    second = keep_tallest(heights[250:], dbhs[250:], orders[250:], 37)
+    merged = keep_tallest(*(np.concatenate(pair) for pair in zip(first, second)), 37)
+    assert merged[2].tolist() == expected
+    assert len(keep_tallest(heights, dbhs, orders, 0)[0]) == 0
+    assert len(keep_tallest(heights[:3], dbhs[:3], orders[:3], 5)[0]) == 3
+
+def test_cli(tmp_path):
+    with patch('builtins.input', side_effect=AssertionError("the command line must not ask questions")):
+        cli(["--csv", "tree_data.csv", "--area", "1000", "--age", "20", "--out-dir", str(tmp_path), "--no-plots"])
+    stand_df = pd.read_csv(tmp_path / "metrics_stand.csv")
+    assert stand_df["Stand Age (yr)"][0] == 20
+    assert stand_df["Site Index"][0] == 20.7043
+    assert len(pd.read_csv(tmp_path / "metrics_tree.csv")) == 80
+    assert not (tmp_path / "chart_tree_dbh_classes.png").exists()
+
+    # whole DBH and heights are written like in the file
+    analyse_stand(r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv").export_to_csv(str(tmp_path / "short_tree.csv"), str(tmp_path / "short_stand.csv"))
+    assert (tmp_path / "short_tree.csv").read_text().splitlines()[1].startswith("1,Pb,1,12,14,")
+    assert (tmp_path / "metrics_tree.csv").read_text().splitlines()[64].startswith("64,Ec,1,28.0,23.3,")  # not when some have decimals
+
+    with pytest.raises(SystemExit, match="There is a negative DBH value"):
+        cli(["--csv", r"more_tree_data/tree_data_negdbh.csv", "--out-dir", str(tmp_path)])
+    with pytest.raises(SystemExit):
+        cli(["--csv", r"more_tree_data/tree_data_extracolumn.csv", "--out-dir", str(tmp_path), "--no-plots"])
+    cli(["--csv", r"more_tree_data/tree_data_extracolumn.csv", "--allow-extra-columns", "--out-dir", str(tmp_path)])
+    assert (tmp_path / "chart_tree_dbh_classes.png").exists()
+
+def test_analyse_trees():
+    df = pd.read_csv(r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv")
+    analysis = analyse_trees(df, area=1000)
+    assert analysis.stand.Main_species == "Pb"
+    assert round(analysis.stand.SDI, 4) == 14.9096
+    assert analysis.stand.Site_index == 0
+
+def test_lazy_imports():
+    from benchmark import bench_startup
+    startup = bench_startup(runs=1)
+    assert not startup["pandas_imported"]
+    assert not startup["matplotlib_imported"]
+
+def test_class_distribution():
+    analysis = analyse_stand(r"more_tree_data/tree_data__perfect_complete.csv")
+    dbh_classes = class_distribution(analysis.trees, "dbh")
+    assert dbh_classes.index[1] == "[7.5,12.5["
+    assert dbh_classes["Trees"].tolist() == [0, 6, 16, 16, 15, 17, 12, 11, 2]
+    by_status = class_distribution(analysis.trees, "dbh", by=["species", "cod_status"])
+    assert by_status[("Ec", 1)].tolist() == [0, 3, 9, 5, 8, 10, 3, 4, 1]
+    assert by_status.to_numpy().sum() == dbh_classes["Trees"].sum()
+    height_classes = class_distribution(analysis.trees, "height", width=10, by="species")
+    assert list(height_classes.columns) == ["Ec", "Pb"]
+    assert height_classes.index[0] == "[2.5,12.5["
+
+    edges, counts = class_counts([7.5, 12.4, 12.5, np.nan, 1], groups=[0, 1, 1, 0, 0], n_groups=2)
+    assert edges.tolist() == [2.5, 7.5, 12.5, 17.5]
+    assert counts.tolist() == [[0, 1, 0], [0, 1, 1]]
+
+def test_export_stand_charts(tmp_path):
+    stands = {
+        "plot_a": analyse_stand(r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv"),
+        "plot_b": analyse_stand(r"tree_data.csv").trees,
+    }
+    paths = export_stand_charts(stands, out_dir=str(tmp_path), workers=2, dpi=50)
+    assert sorted(os.listdir(tmp_path)) == ["plot_a_dbh_classes.png", "plot_a_height_classes.png", "plot_b_dbh_classes.png", "plot_b_height_classes.png"]
+    assert paths["plot_b"][1] == os.path.join(str(tmp_path), "plot_b_height_classes.png")
+    with open(paths["plot_a"][0], "rb") as f:
+        assert f.read(8) == b"\x89PNG\r\n\x1a\n"
+
+def test_export_tables(tmp_path):
+    pytest.importorskip("pyarrow")
+    analysis = analyse_stand(r"tree_data.csv")
+    tree_path, stand_path = analysis.export_tables(str(tmp_path), "parquet")
+    trees_df = pd.read_parquet(tree_path)
+    assert list(trees_df.columns) == list(analysis.tree_metrics_table().columns)
+    assert trees_df["Tree ID"].dtype == np.int64
+    assert trees_df["COD_Status"].dtype == np.int8
+    assert trees_df["Species"].dtype == "category"
+    assert trees_df["Volume (m³)"].tolist() == analysis.trees.tree_volume.tolist()  # full values, not rounded
+    assert pd.read_parquet(stand_path)["Tree Density (trees/ha)"][0] == 730
+
+    tree_path, _ = analysis.export_tables(str(tmp_path), "feather")
+    assert tree_path.endswith("metrics_tree.feather")
+    assert len(pd.read_feather(tree_path)) == 80
+
+def test_update_trees():
+    df = pd.read_csv(r"tree_data.csv")
+    analysis = analyse_trees(df, 1000, 20)
+    changes = pd.DataFrame({"tree_ID": [3, 500, 501], "species": ["Ec", "Ec", "Ec"], "DBH": [40.0, np.nan, 7.0], "height": [np.nan, 35.0, 8.0], "COD_Status": [1, 1, 1]})
+    analysis.update_trees(changes, removed=[5, 10])
+
+    df = df[~df["tree_ID"].isin([5, 10])].set_index("tree_ID")
+    df.loc[3] = changes.set_index("tree_ID").loc[3]
+    df = pd.concat([df.reset_index(), changes.iloc[[1, 2]]], ignore_index=True)
+    expected = analyse_trees(df, 1000, 20)
+    for name, value in vars(expected.stand).items():
+        assert getattr(analysis.stand, name) == pytest.approx(value)
+    assert analysis.tree_metrics_table().equals(expected.tree_metrics_table())
+
+    # without the tall trees hdom falls below 10.71 m and the Ec biomass of every tree changes
+    analysis.update_trees(removed=analysis.trees.tree_ID[analysis.trees.est_height > 11].tolist())
+    expected = analyse_trees(df[df["tree_ID"].isin(analysis.trees.tree_ID)].reset_index(drop=True), 1000, 20)
+    assert analysis.stand.hdom < 10.71
+    assert analysis.stand.hdom == pytest.approx(expected.stand.hdom)
+    assert analysis.tree_metrics_table().equals(expected.tree_metrics_table())
+
+    with pytest.raises(ValueError, match="Tree ID 9999 is not in the table, please correct and restart."):
+        analysis.update_trees(removed=[9999])
+
+def test_update_trees_longer_species_code(tmp_path):
+    with open("species_models.json") as file:
+        data = json.load(file)
+    data["species"]["Pnig"] = dict(data["species"]["Pb"], name="Pinus nigra")
+    with open(tmp_path / "regional.json", "w") as file:
+        json.dump(data, file)
+    try:
+        load_species_models(str(tmp_path / "regional.json"))
+        df = pd.read_csv(r"tree_data.csv")
+        analysis = analyse_trees(df, 1000, 20)
+        assert analysis.trees.species.dtype.itemsize < np.dtype("<U4").itemsize  # the codes of the file are shorter
+        changes = df[df["tree_ID"] == 1].assign(species="Pnig")
+        analysis.update_trees(changes)
+        expected = analyse_trees(df.assign(species=df["species"].where(df["tree_ID"] != 1, "Pnig")), 1000, 20)
+        assert analysis.trees.species[analysis.trees.row_of(1)] == "Pnig"
+        assert analysis.tree_metrics_table().equals(expected.tree_metrics_table())
+    finally:
+        load_species_models()
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_entries=2)
+    with patch.object(cache, "key", wraps=cache.key) as key:
+        analysis = analyse_stand(r"tree_data.csv", 1000, 20, cache=cache)
+    assert key.call_count == 1  # a new file is only hashed once
+    with patch("project.InventoryAnalysis.from_csv") as from_csv:
+        cached = analyse_stand(r"tree_data.csv", 1000, 20, cache=cache)
+        from_csv.assert_not_called()
+    assert vars(cached.stand) == vars(analysis.stand)
+    assert cached.tree_metrics_table().equals(analysis.tree_metrics_table())
+
+    # another area or age is another analysis, and only the 2 most recently used are kept
+    assert analyse_stand(r"tree_data.csv", 500, 20, cache=cache).stand.Area == 500
+    analyse_stand(r"tree_data.csv", 1000, None, cache=cache)
+    assert len(os.listdir(tmp_path / "cache")) == 2
+    assert cache.get(cache.key(r"tree_data.csv", 1000, 20)) is None
+
+def test_benchmark_inventory(tmp_path):
+    import benchmark
+    path = benchmark.generate_inventory(2000, str(tmp_path / "inventory.csv"))
+    df = pd.read_csv(path)
+    columns, errors = validate_tree_data(df)
+    assert errors == []
+    assert len(df) == 2000
+    assert set(df["species"]) == set(SPECIES)
+    assert 0.3 < df["height"].isna().mean() < 0.5
+    stages = benchmark.run_stages(path)
+    assert list(stages) == ["read_csv", "create_tree_objects", "calculate_missing_dbh_h", "stand_metrics", "export_to_csv"]
+    assert benchmark.compare_to_baseline({"stages": {"2000": {"stand_metrics": {"seconds": 1.0}}}}, {"stages": {"2000": {"stand_metrics": {"seconds": 0.5}}}}) == ["stand_metrics with 2000 trees: 1.0s, was 0.5s"]
+
+def test_stage_profiler(tmp_path):
+    records = []
+    analysis = analyse_stand(r"tree_data.csv", profiler=StageProfiler(callback=records.append))
+    assert [record["stage"] for record in records] == ["read_data", "calculate_missing_dbh_h", "stand_metrics"]
+    assert all(record["rows"] == len(analysis.trees) == 80 for record in records)
+    assert set(records[0]) == {"stage", "rows", "seconds", "rows_per_second", "peak_rss_mb"}
+
+    cli(["--csv", "tree_data.csv", "--out-dir", str(tmp_path), "--profile", str(tmp_path / "profile.json")])
+    with open(tmp_path / "profile.json") as file:
+        report = json.load(file)
+    assert [record["stage"] for record in report["stages"]] == ["read_data", "calculate_missing_dbh_h", "stand_metrics", "export_to_csv", "create_histogram"]
+    assert report["total_seconds"] > 0
+
+def test_estimate_missing_dbh_h_table():
+    species = np.array(["Pb", "Ec", "Pm", "Sb", "Pb", "Sb"])
+    dbh = np.array([20.0, 15.0, 30.0, 40.0, np.nan, np.nan])
+    height = np.array([np.nan, np.nan, np.nan, np.nan, 12.0, 8.0])
+    est_dbh, est_height = estimate_missing_dbh_h(species, dbh, height)
+    assert est_height[:4].tolist() == [round(20 / (1.0643 + 0.0222 * 20), 2), round(15 / (0.6733 + 0.0130 * 15), 2), round(30 / (1.8104 + 0.0388 * 30), 2), 10.44]
+    assert est_dbh[4:].tolist() == [round(-12 * 1.0643 / (12 * 0.0222 - 1), 2), round(-8 * 2.1124 / (8 * 0.0293 - 1), 2)]
+
+    # a new species only needs its coefficients in the table
+    with patch.dict(HD_COEFFICIENTS, {"Xx": (1.0, 0.02, 0, 1)}):
+        est_dbh, est_height = estimate_missing_dbh_h(np.array(["Xx"]), np.array([25.0]), np.array([np.nan]))
+    assert est_height.tolist() == [round(25 / (1.0 + 0.02 * 25), 2)]
+
+def test_species_models(tmp_path):
+    with open("species_models.json") as file:
+        data = json.load(file)
+    assert list(data["species"]) == SPECIES
+    assert species_error() == "There is a species value that is not acceptable (not 'Pb', 'Pm', 'Ec', or 'Sb'), please correct and restart"
+
+    # a regional file with one more species, its trees are calculated like the others
+    data["species"]["Pn"] = dict(data["species"]["Pb"], name="Pinus nigra")
+    with open(tmp_path / "regional.json", "w") as file:
+        json.dump(data, file)
+    try:
+        load_species_models(str(tmp_path / "regional.json"))
+        df = pd.read_csv(r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv")
+        expected = analyse_trees(df)
+        analysis = analyse_trees(df.assign(species=df["species"].replace("Pb", "Pn")))
+        assert analysis.stand.Main_species == "Pn"
+        assert analysis.stand.SDI == expected.stand.SDI
+        assert analysis.trees.total_biom.tolist() == expected.trees.total_biom.tolist()
+        with pytest.raises(ValueError, match=re.escape("(not 'Pb', 'Pm', 'Ec', 'Sb', or 'Pn')")):
+            analyse_trees(df.assign(species="Xx"))
+    finally:
+        load_species_models()
+
+def test_wood_assortments():
+    analysis = analyse_trees(pd.read_csv(r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv"))
+    assortments = wood_assortments(analysis.trees)
+    totals = assortments.groupby("Tree ID")["Value (€)"].sum()
+    alive = analysis.trees.take((analysis.trees.cod_status == 1) & np.isin(analysis.trees.species, ["Pb", "Ec"]))
+    assert np.allclose(totals.loc[alive.tree_ID].to_numpy(), alive.wood_value)
+    assert set(assortments["Assortment"]) <= {"Sawlogs 35+ cm", "Sawlogs 15-35 cm", "Pulpwood 7-15 cm", "Pulpwood 6+ cm"}
+
+    # the same trees at a higher sawlog price
+    try:
+        load_species_models().set_prices({"Pb": {"Sawlogs 15-35 cm": 60}})
+        pines = (alive.species == "Pb")
+        sawlogs = assortments[assortments["Assortment"] == "Sawlogs 15-35 cm"].set_index("Tree ID")["Volume (m³)"]
+        expected = alive.wood_value[pines] + 30 * sawlogs.loc[alive.tree_ID[pines]].to_numpy()
+        repriced = analyse_trees(pd.read_csv(r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv")).trees
+        repriced = repriced.take((repriced.cod_status == 1) & (repriced.species == "Pb"))
+        assert np.allclose(repriced.wood_value, expected)
+    finally:
+        load_species_models()
+
+def test_stand_uncertainty(tmp_path):
+    analysis = analyse_stand(r"tree_data.csv", age=30)
+    bands = analysis.uncertainty(replicates=400, seed=1)
+    assert list(bands.columns) == ["Metric", "Estimate", "P2.5", "P50", "P97.5"]
+    assert (bands["P2.5"] <= bands["P50"]).all() and (bands["P50"] <= bands["P97.5"]).all()
+    inside = bands[bands["Metric"] != "Site Index"]
+    assert ((inside["P2.5"] <= inside["Estimate"]) & (inside["Estimate"] <= inside["P97.5"])).all()
+    assert bands.equals(stand_uncertainty(analysis, replicates=400, seed=1, workers=1))
+
+    # without noise in the equations the volume only changes with the trees that are drawn
+    bands = analysis.uncertainty(replicates=200, coefficient_cv=0, seed=2).set_index("Metric")
+    assert bands.loc["Total Volume (m³/ha)", "P97.5"] < analysis.uncertainty(replicates=200, coefficient_cv=0.2, seed=2).set_index("Metric").loc["Total Volume (m³/ha)", "P97.5"]
+
+    # with a random area the number of dominant trees is the one of the area of each replicate
+    replicates = uncertainty_replicates(analysis, 20, 3, area_cv=0.3)
+    counts = np.random.default_rng(3).multinomial(len(analysis.trees), np.full(len(analysis.trees), 1 / len(analysis.trees)), size=20)
+    alive = analysis.trees.cod_status == 1
+    for i in range(20):
+        area = counts[i][alive].sum() * 10000 / replicates["N"][i]
+        eligible = alive & (analysis.trees.species == analysis.stand.Main_species)
+        heights = np.sort(np.repeat(analysis.trees.est_height[eligible], counts[i][eligible]))[::-1]
+        assert replicates["hdom"][i] == pytest.approx(heights[:min(int(area * 100 / 10000), len(heights))].mean())
+    assert len(set((np.sum(counts[:, alive], axis=1) * 10000 / replicates["N"] * 100 / 10000).astype(int))) > 1
+
+    cli(["--csv", "tree_data.csv", "--out-dir", str(tmp_path), "--no-plots", "--uncertainty", "50"])
+    assert len(pd.read_csv(tmp_path / "metrics_uncertainty.csv")) == len(UNCERTAINTY_METRICS)
+
+def test_stratified_estimates(tmp_path):
+    plots = pd.DataFrame({
+        "Plot": ["a1", "a2", "a3", "b1", "b2", "c1"],
+        "Stratum": ["A", "A", "A", "B", "B", "C"],
+        "Total Volume (m³/ha)": [100.0, 120.0, 140.0, 50.0, 70.0, 300.0],
+        "Error": ["", "", "", "", "", ""],
+    })
+    strata_df, estate_df = stratified_estimates(plots, {"A": 10, "B": 30, "C": 60}, metrics=["Total Volume (m³/ha)"])
+    a, b, c = strata_df.to_dict("records")
+    assert a["Plots"] == 3 and a["Mean (/ha)"] == 120 and a["Variance"] == 400 and a["Total"] == 1200
+    assert round(a["Standard Error"], 6) == round(math.sqrt(400 / 3), 6)
+    assert b["Total"] == 1800 and np.isnan(c["Variance"])
+    estate = estate_df.iloc[0]
+    assert estate["Total"] == 1200 + 1800 + 18000 and estate["Area (ha)"] == 100 and estate["Plots"] == 6
+    assert estate["Strata Without Variance"] == 1  # stratum C, left out of the standard error
+    assert estate["Standard Error"] == pytest.approx(math.sqrt(0.1 ** 2 * 400 / 3 + 0.3 ** 2 * 200 / 2))
+
+    with pytest.raises(ValueError, match="There is no area for the strata C"):
+        stratified_estimates(plots, {"A": 10, "B": 30}, metrics=["Total Volume (m³/ha)"])
+
+    # a batch whose manifest has the stratum of each plot
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(
+        "file,area,stratum\n"
+        f"{os.path.abspath('more_tree_data/tree_data__perfect_short_Pb_Ec.csv')},1000,pine\n"
+        f"{os.path.abspath('more_tree_data/tree_data__perfect_long.csv')},1000,pine\n"
+        f"{os.path.abspath('tree_data.csv')},1000,eucalyptus\n"
+    )
+    (tmp_path / "strata.csv").write_text("stratum,area\npine,12.5\neucalyptus,40\n")
+    cli(["--batch", str(manifest), "--out-dir", str(tmp_path / "out"), "--no-plots", "--workers", "2", "--strata", str(tmp_path / "strata.csv")])
+    estate_df = pd.read_csv(tmp_path / "out" / "metrics_estate.csv")
+    assert estate_df["Metric"].tolist() == ESTIMATE_METRICS and (estate_df["Area (ha)"] == 52.5).all()
+    assert estate_df["Sampling Error (%)"].notna().all() and (estate_df["Strata Without Variance"] == 1).all()
+    assert set(pd.read_csv(tmp_path / "out" / "metrics_strata.csv")["Stratum"]) == {"pine", "eucalyptus"}
+
+def test_project_growth():
+    pines = analyse_stand(r"more_tree_data/tree_data__perfect_long.csv", age=30)
+    eucalyptus = analyse_stand(r"tree_data.csv", age=5)
+    no_age = analyse_stand(r"tree_data.csv")
+    growth = project_growth({"pines": pines, "eucalyptus": eucalyptus, "no age": no_age}, years=20, step=10, scenarios={"Base": {}, "Mortality": {"mortality": 0.02}})
+    assert set(growth["Stand"]) == {"pines", "eucalyptus"} and len(growth) == 2 * 2 * 3
+    base = growth[growth["Scenario"] == "Base"].set_index(["Stand", "Age"])
+
+    # the first year is the analysed stand
+    now = base.loc[("pines", 30)]
+    stand = pines.stand
+    assert np.allclose([now["Dominant Height (m)"], now["Tree Density (trees/ha)"], now["Total Basal Area (m²/ha)"], now["Total Volume (m³/ha)"], now["Total Wood Value (€/ha)"]],
+                       [stand.hdom, stand.N, stand.G_pov, stand.V_pov, stand.Value_pov])
+    # hdom follows the site index curve: at the reference age (50 for Pb) it is the site index
+    assert round(base.loc[("pines", 50), "Dominant Height (m)"], 6) == round(stand.Site_index, 6)
+    assert (np.diff(base.loc["eucalyptus", "Total Volume (m³/ha)"]) > 0).all()
+
+    mortality = growth[growth["Scenario"] == "Mortality"].set_index(["Stand", "Age"])
+    assert np.allclose(mortality.loc[("pines", 50), "Tree Density (trees/ha)"], stand.N * 0.98 ** 20)
+
+def test_thinning_scenarios():
+    analysis = analyse_stand(r"tree_data.csv", age=30)
+    scenarios = [
+        {"name": "none", "removal": 0},
+        {"name": "below", "method": "below", "removal": 0.3},
+        {"name": "above", "method": "above", "removal": 0.3},
+        {"name": "sdi", "target_sdi": 500},
+        {"name": "fw", "target_fw": 0.2},
+    ]
+    results = analysis.thinning_scenarios(scenarios).set_index("Scenario")
+    none, below, above, sdi, fw = results.to_dict("records")
+    expected = analysis.stand_metrics_table().iloc[0]
+    assert none["Removed Trees (trees/ha)"] == 0 and none["Stand Density Index"] == expected["Stand Density Index"]
+    assert below["Removed Trees (trees/ha)"] == above["Removed Trees (trees/ha)"] == 220
+    assert below["Removed Volume (m³/ha)"] < above["Removed Volume (m³/ha)"]
+    assert below["Removed Volume (m³/ha)"] + below["Total Volume (m³/ha)"] == pytest.approx(expected["Total Volume (m³/ha)"])
+    assert sdi["Stand Density Index"] <= 500 and fw["Wilson Factor"] >= 0.2
+
+    # the same result as analysing the remaining trees again
+    stand, removed, reached = thin(analysis, scenarios[1])
+    assert reached
+    df = pd.read_csv(r"tree_data.csv")
+    again = analyse_trees(df[~df["tree_ID"].isin(analysis.trees.tree_ID[removed])], age=30).stand
+    assert (stand.N, round(stand.hdom, 6), round(stand.SDI, 6), round(stand.Value_pov, 6)) == (again.N, round(again.hdom, 6), round(again.SDI, 6), round(again.Value_pov, 6))
+
+    # targets that cannot be reached remove nothing and are flagged
+    unreachable = analysis.thinning_scenarios([{"target_sdi": 1}, {"target_fw": 100}, {"species": ["Pb"], "target_sdi": 1}])
+    assert not unreachable["Target Reached"].any() and (unreachable["Removed Trees (trees/ha)"] == 0).all()
+    assert results["Target Reached"].all()
+
+    # the SDI that chooses the trees is the one reported, also when the thinning changes the main species
+    mixed = analyse_trees(pd.DataFrame({"tree_ID": range(1, 7), "species": ["Pb"] * 4 + ["Ec"] * 2, "DBH": [20.0, 25, 30, 35, 15, 40], "height": [15.0, 17, 19, 21, 14, 25], "COD_Status": 1}))
+    order = thinning_order(mixed, "below", ["Ec"])
+    assert mixed.stand.Main_species == "Mixed Stand" and thinned_stand(mixed, removal_mask(mixed.trees, order[:1])).Main_species == "Pb"
+    sdi = thinned_sdi(mixed, order)
+    assert np.isnan(sdi[0])  # a mixed stand has no SDI
+    assert sdi[1:].tolist() == pytest.approx([thinned_stand(mixed, removal_mask(mixed.trees, order[:k])).SDI for k in range(1, len(order) + 1)])
+    with pytest.raises(ValueError, match="The stand has no SDI"):
+        thin(mixed, {"target_sdi": 100})
+
+    # removing pines until the stand is mixed does not reach an SDI target
+    pines = analyse_trees(pd.DataFrame({"tree_ID": range(1, 21), "species": ["Pb"] * 16 + ["Ec"] * 4, "DBH": np.linspace(15, 40, 20),
+                                        "height": np.linspace(12, 22, 20), "COD_Status": 1}))
+    assert pines.stand.Main_species == "Pb"
+    results = pines.thinning_scenarios([{"species": ["Pb"], "target_sdi": 1}, {"species": ["Pb"], "target_sdi": 0.95 * pines.stand.SDI}])
+    assert not results["Target Reached"].iloc[0] and results["Removed Trees (trees/ha)"].iloc[0] == 0
+    assert results["Target Reached"].iloc[1] and results["Pure Stand"].iloc[1] == "Pb"
+    assert results["Stand Density Index"].iloc[1] <= 0.95 * pines.stand.SDI
+
+    # the Wilson factor falls when the stand becomes mixed, every number of removed trees is evaluated
+    order = thinning_order(pines, "above", ["Pb"])
+    fw = [thinned_stand(pines, removal_mask(pines.trees, order[:k])).Fw for k in range(len(order) + 1)]
+    assert thinned_fw(pines, order).tolist() == pytest.approx(fw)
+    assert fw[4] > fw[5]
+    for target in [0.5, 0.7, 0.74]:
+        stand, removed, reached = thin(pines, {"method": "above", "species": ["Pb"], "target_fw": target}, order)
+        assert reached and np.count_nonzero(removed) == next(k for k in range(len(fw)) if fw[k] >= target)
+    order = thinning_order(mixed, "below", ["Ec"])
+    assert thinned_fw(mixed, order).tolist() == pytest.approx([thinned_stand(mixed, removal_mask(mixed.trees, order[:k])).Fw for k in range(len(order) + 1)])
+
+    with pytest.raises(ValueError, match="A thinning scenario needs one of"):
+        thin(analysis, {"removal": 0.2, "target_sdi": 400})
+
+def test_analysis_service():
+    import asyncio
+    import urllib.request
+    import urllib.error
+    df = pd.read_csv(r"tree_data.csv")
+    expected = analyse_trees(df, area=500, age=30)
+
+    def post(port, data, content_type="application/json", query=""):
+        request = urllib.request.Request(f"http://127.0.0.1:{port}/analyse{query}", data=data, headers={"Content-Type": content_type})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    async def run():
+        service = AnalysisService(batch_window=0.05)
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        loop = asyncio.get_running_loop()
+        body = json.dumps({"trees": json.loads(df.to_json(orient="records")), "area": 500, "age": 30, "include_trees": True}).encode()
+        calls = [loop.run_in_executor(None, post, port, body) for _ in range(6)]
+        calls.append(loop.run_in_executor(None, post, port, df.to_csv(index=False).encode(), "text/csv", "?area=500&age=30"))
+        calls.append(loop.run_in_executor(None, post, port, json.dumps({"csv": "tree_ID,species,DBH,height,COD_Status\n1,Xx,20,15,1\n"}).encode()))
+        results = await asyncio.gather(*calls)
+
+        # requests that are not valid get an error answer, the connection is not dropped
+        invalid = [json.dumps({"trees": json.loads(df.to_json(orient="records")), "area": None}).encode(), b"[1, 2]", json.dumps({"trees": 5}).encode()]
+        answers = await asyncio.gather(*[loop.run_in_executor(None, post, port, data) for data in invalid])
+        assert [status for status, _ in answers] == [400, 400, 400]
+        assert answers[0][1]["error"] == "The area and the age must be numbers, please correct and restart."
+        assert answers[2][1]["error"].startswith("'trees' must be a list of trees")
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"NONSENSE\r\n\r\n")
+        assert (await reader.read()).startswith(b"HTTP/1.1 400 Bad Request")
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return service, results
+
+    service, results = asyncio.run(run())
+    *ok, failed = results
+    assert all(status == 200 for status, _ in ok)
+    assert all(payload["stand"]["Stand Density Index"] == round(expected.stand.SDI, 4) for _, payload in ok)
+    assert np.allclose([tree["Total Biomass (kg)"] for tree in ok[0][1]["trees"]], expected.trees.total_biom)
+    assert failed[0] == 400 and "species value that is not acceptable" in failed[1]["error"]
+    assert service.requests == 8 and service.batches < 8  # the requests that arrived together were analysed together
+
+def test_analyse_tree_batch():
+    frames = [pd.read_csv(path) for path in [r"tree_data.csv", r"more_tree_data/tree_data__perfect_short_Pb_Ec.csv", r"more_tree_data/tree_data__perfect_long.csv"]]
+    zero_height = pd.DataFrame({"tree_ID": [1], "species": ["Pb"], "DBH": [20.0], "height": [0.0], "COD_Status": [1]})  # hdom is 0
+    results = analyse_tree_batch([(df, 1000, 20) for df in frames] + [(frames[0].iloc[:0], 1000, None), (zero_height, 1000, None)])
+    for df, analysis in zip(frames, results):
+        expected = analyse_trees(df, age=20)
+        assert analysis.stand_metrics_table().equals(expected.stand_metrics_table())
+        assert analysis.tree_metrics_table().equals(expected.tree_metrics_table())
+    assert isinstance(results[-2], ValueError)
+    assert isinstance(results[-1], ZeroDivisionError)  # a stand that fails in its totals does not stop the others